@@ -0,0 +1,565 @@
+"""Local stand-in for the Gmail API serving a synthetic mailbox
+
+Covers the endpoints used by gmailsort: getProfile, messages.list/get,
+history.list, labels.list/create, messages.batchModify and the HTTP batch
+endpoint. Latency, quota errors (403/429) and backend errors (5xx) can be
+injected. Fields masks are accepted, but complete responses are returned.
+Only HTTP/1.1 without TLS is served, so HTTP/2 multiplexing of the async
+engine (negotiated via TLS) cannot be exercised: it sends a single
+request per connection at a time.
+Run from the project directory to serve a mailbox until interrupted:
+
+    python -m benchmarks.fakegmail [NUM_MESSAGES] [PORT]
+
+Point a client at it with 'gmail_api.Client(..., root_url=URL)'.
+Besides the API, the server provides '/_admin/stats' (GET, request
+counters), '/_admin/reset' (POST, reset counters) and '/_admin/mutate'
+(POST, json with numbers of messages to 'add', 'modify' and 'delete'
+and an optional 'expire' flag dropping the history).
+"""
+import gzip
+import json
+import random
+import re
+import sys
+import threading
+import time
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import accumulate
+from urllib.parse import parse_qs, urlsplit
+
+# Gmail API path prefix of user resources
+USER_PATH = "/gmail/v1/users/me/"
+
+# Paths of the HTTP batch endpoint (generic and API-specific)
+BATCH_PATHS = ("/batch", "/batch/gmail/v1")
+
+# Minimum response size in bytes for gzip compression
+GZIP_MIN_SIZE = 1024
+
+# Internal dates of messages are spread over this range (Gmail launch
+# until 2024-01-01)
+START_TIME = 1080777600
+END_TIME = 1704067200
+
+# Labels of all mailboxes (system labels and categories)
+SYSTEM_LABELS = [
+    "INBOX",
+    "SENT",
+    "DRAFT",
+    "SPAM",
+    "TRASH",
+    "UNREAD",
+    "STARRED",
+    "IMPORTANT",
+    "CATEGORY_PERSONAL",
+    "CATEGORY_SOCIAL",
+    "CATEGORY_PROMOTIONS",
+    "CATEGORY_UPDATES",
+    "CATEGORY_FORUMS",
+]
+
+TOP_LEVEL_DOMAINS = ["com", "com", "com", "de", "org", "net", "co.uk", "fr"]
+
+SUBDOMAINS = ["", "", "mail.", "news.", "info.", "email."]
+
+LOCAL_PARTS = ["info", "news", "noreply", "hello", "support", "team"]
+
+
+def error_body(code, reason, message):
+    return {
+        "error": {
+            "code": code,
+            "message": message,
+            "errors": [{"reason": reason, "message": message}],
+        }
+    }
+
+
+# Injected errors: (status code, reason, message)
+QUOTA_ERRORS = [
+    (429, "rateLimitExceeded", "Too many requests"),
+    (403, "userRateLimitExceeded", "User-rate limit exceeded"),
+]
+BACKEND_ERRORS = [
+    (500, "backendError", "Backend error"),
+    (503, "backendError", "Service unavailable"),
+]
+
+
+class Mailbox:
+    """Synthetic mailbox with history of all changes
+
+    Messages have 16 hex digit ids derived from their index, sender
+    domains following a Zipf distribution and internal dates increasing
+    with their index. Labels are stored as sets of label ids.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, num_messages, num_domains=None, seed=0):
+        self.random = random.Random(seed)
+        num_domains = num_domains or max(10, num_messages // 50)
+        self.domains = [
+            f"domain{i}.{self.random.choice(TOP_LEVEL_DOMAINS)}"
+            for i in range(num_domains)
+        ]
+        # Zipf distribution: few domains send most messages (cumulative
+        # weights, which would be summed up on every draw otherwise)
+        self.__cum_weights = list(
+            accumulate(1 / (rank + 1) for rank in range(num_domains))
+        )
+        self.labels = {
+            label_id: {"id": label_id, "name": label_id, "type": "system"}
+            for label_id in SYSTEM_LABELS
+        }
+        # User labels for the most frequent domains, so that messages can
+        # be sorted
+        for rank, domain in enumerate(self.domains[:100]):
+            self.__add_label(f"Label_{rank}", f"Sorted/{domain.split('.')[0]}")
+        self.senders = []
+        self.label_ids = []
+        self.deleted = set()
+        self.history = []
+        self.history_id = 1000
+        # Oldest start history id still available
+        self.min_history_id = self.history_id
+        self.lock = threading.Lock()
+        # Filtered message indices by query, cleared on every change
+        self.__listings = {}
+        # Messages added later are dated after END_TIME
+        self.__date_step = (END_TIME - START_TIME) / max(1, num_messages)
+        for _ in range(num_messages):
+            self.__add_message()
+
+    def __add_label(self, label_id, name):
+        self.labels[label_id] = {"id": label_id, "name": name, "type": "user"}
+
+    def __add_message(self):
+        domain = self.random.choices(
+            self.domains, cum_weights=self.__cum_weights
+        )[0]
+        self.senders.append(
+            f"{domain.split('.')[0].title()} <"
+            f"{self.random.choice(LOCAL_PARTS)}@"
+            f"{self.random.choice(SUBDOMAINS)}{domain}>"
+        )
+        label_ids = {"INBOX"}
+        roll = self.random.random()
+        if roll < 0.05:
+            label_ids = {"SENT"}
+        elif roll < 0.06:
+            label_ids = {"SPAM"}
+        elif roll < 0.5:
+            label_ids.add("CATEGORY_PROMOTIONS")
+        if self.random.random() < 0.3:
+            label_ids.add("UNREAD")
+        self.label_ids.append(label_ids)
+        return len(self.senders) - 1
+
+    @staticmethod
+    def message_id(index):
+        return f"{index + 0x180000000000000:016x}"
+
+    def index(self, message_id):
+        try:
+            index = int(message_id, 16) - 0x180000000000000
+        except ValueError:
+            return None
+        if 0 <= index < len(self.senders) and index not in self.deleted:
+            return index
+        return None
+
+    def internal_date(self, index):
+        # Milliseconds since epoch, increasing with the index
+        return int((START_TIME + index * self.__date_step) * 1000)
+
+    def get_message(self, index, minimal=False):
+        message_id = self.message_id(index)
+        message = {"id": message_id, "threadId": message_id}
+        if minimal:
+            return message
+        message.update(
+            {
+                "labelIds": sorted(self.label_ids[index]),
+                "snippet": f"Synthetic message {index}",
+                "sizeEstimate": 2048 + index % 4096,
+                "historyId": str(self.history_id),
+                "internalDate": str(self.internal_date(index)),
+                "payload": {
+                    "partId": "",
+                    "mimeType": "text/plain",
+                    "headers": [
+                        {"name": "From", "value": self.senders[index]},
+                        {"name": "Subject", "value": f"Subject {index}"},
+                    ],
+                },
+            }
+        )
+        return message
+
+    def list_messages(self, query, label_ids, include_spam_trash):
+        # Newest messages first
+        key = (query, tuple(sorted(label_ids)), include_spam_trash)
+        listing = self.__listings.get(key)
+        if listing is not None:
+            return listing
+        after = re.search(r"after:(\d+)", query)
+        before = re.search(r"before:(\d+)", query)
+        after = int(after.group(1)) * 1000 if after else None
+        before = int(before.group(1)) * 1000 if before else None
+        excluded = set() if include_spam_trash else {"SPAM", "TRASH"}
+        label_ids = set(label_ids)
+        listing = [
+            index
+            for index in range(len(self.senders) - 1, -1, -1)
+            if index not in self.deleted
+            and label_ids <= self.label_ids[index]
+            and excluded.isdisjoint(self.label_ids[index])
+            and (after is None or self.internal_date(index) > after)
+            and (before is None or self.internal_date(index) < before)
+        ]
+        self.__listings[key] = listing
+        return listing
+
+    def __record(self, key, index, label_ids=None):
+        self.history_id += 1
+        record = {"message": {"id": self.message_id(index)}}
+        if label_ids is not None:
+            record["labelIds"] = sorted(label_ids)
+        self.history.append({"id": str(self.history_id), key: [record]})
+        self.__listings.clear()
+
+    def modify(self, index, add_label_ids=(), remove_label_ids=()):
+        added = set(add_label_ids) - self.label_ids[index]
+        removed = set(remove_label_ids) & self.label_ids[index]
+        self.label_ids[index] |= added
+        self.label_ids[index] -= removed
+        if added:
+            self.__record("labelsAdded", index, added)
+        if removed:
+            self.__record("labelsRemoved", index, removed)
+
+    def create_label(self, name):
+        label_id = f"Label_{len(self.labels)}"
+        self.__add_label(label_id, name)
+        return self.labels[label_id]
+
+    def mutate(self, add=0, modify=0, delete=0, expire=False):
+        """Applies random changes as made by other clients"""
+        for _ in range(add):
+            self.__record("messagesAdded", self.__add_message())
+        indices = [i for i in range(len(self.senders)) if i not in self.deleted]
+        for index in self.random.sample(indices, min(modify, len(indices))):
+            if "UNREAD" in self.label_ids[index]:
+                self.modify(index, remove_label_ids=["UNREAD"])
+            else:
+                self.modify(index, add_label_ids=["STARRED"])
+        for index in self.random.sample(indices, min(delete, len(indices))):
+            self.deleted.add(index)
+            self.__record("messagesDeleted", index)
+        if expire:
+            self.history.clear()
+            self.min_history_id = self.history_id
+
+    @property
+    def num_messages(self):
+        return len(self.senders) - len(self.deleted)
+
+
+class Server(ThreadingHTTPServer):
+    """HTTP server of a mailbox with fault injection and statistics"""
+
+    daemon_threads = True
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        mailbox,
+        port=0,
+        latency=0.0,
+        quota_error_rate=0.0,
+        backend_error_rate=0.0,
+    ):
+        super().__init__(("127.0.0.1", port), Handler)
+        self.mailbox = mailbox
+        self.latency = latency
+        self.quota_error_rate = quota_error_rate
+        self.backend_error_rate = backend_error_rate
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.stats = {
+                "http_requests": 0,
+                "api_calls": {},
+                "errors": {},
+                "bytes_sent": 0,
+            }
+
+    def count(self, key, name, value=1):
+        with self.stats_lock:
+            if name is None:
+                self.stats[key] += value
+            else:
+                self.stats[key][name] = self.stats[key].get(name, 0) + value
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}/"
+
+    def inject_error(self):
+        # Returns an injected error response or None
+        roll = random.random()
+        if roll < self.quota_error_rate:
+            errors = QUOTA_ERRORS
+        elif roll < self.quota_error_rate + self.backend_error_rate:
+            errors = BACKEND_ERRORS
+        else:
+            return None
+        (code, reason, message) = random.choice(errors)
+        self.count("errors", str(code))
+        return (code, error_body(code, reason, message), {"Retry-After": "1"})
+
+    def dispatch(self, method, url, body):
+        """Handles a single API call, returns (status, body, headers)"""
+        if self.latency:
+            time.sleep(self.latency)
+        parts = urlsplit(url)
+        if not parts.path.startswith(USER_PATH):
+            return (404, error_body(404, "notFound", "Not Found"), {})
+        path = parts.path[len(USER_PATH) :]
+        params = parse_qs(parts.query)
+        self.count(
+            "api_calls", f"{method} {re.sub(r'/[0-9a-f]{16}$', '/{id}', path)}"
+        )
+        error = self.inject_error()
+        if error:
+            return error
+        with self.mailbox.lock:
+            return self.__dispatch(method, path, params, body)
+
+    # pylint: disable=too-many-return-statements
+    def __dispatch(self, method, path, params, body):
+        mailbox = self.mailbox
+
+        def param(name, default=None):
+            return params.get(name, [default])[0]
+
+        if method == "GET" and path == "profile":
+            return (
+                200,
+                {
+                    "emailAddress": "user@example.com",
+                    "messagesTotal": mailbox.num_messages,
+                    "threadsTotal": mailbox.num_messages,
+                    "historyId": str(mailbox.history_id),
+                },
+                {},
+            )
+        if method == "GET" and path == "messages":
+            listing = mailbox.list_messages(
+                param("q", ""),
+                params.get("labelIds", []),
+                param("includeSpamTrash") == "true",
+            )
+            offset = int(param("pageToken") or 0)
+            max_results = int(param("maxResults", 100))
+            response = {
+                "messages": [
+                    mailbox.get_message(index, minimal=True)
+                    for index in listing[offset : offset + max_results]
+                ],
+                "resultSizeEstimate": len(listing),
+            }
+            if offset + max_results < len(listing):
+                response["nextPageToken"] = str(offset + max_results)
+            return (200, response, {})
+        if method == "GET" and path.startswith("messages/"):
+            index = mailbox.index(path[len("messages/") :])
+            if index is None:
+                return (404, error_body(404, "notFound", "Not Found"), {})
+            return (200, mailbox.get_message(index), {})
+        if method == "POST" and path == "messages/batchModify":
+            for message_id in body.get("ids", []):
+                index = mailbox.index(message_id)
+                if index is not None:
+                    mailbox.modify(
+                        index,
+                        body.get("addLabelIds", []),
+                        body.get("removeLabelIds", []),
+                    )
+            return (204, None, {})
+        if method == "GET" and path == "history":
+            start_history_id = int(param("startHistoryId", 0))
+            if start_history_id < mailbox.min_history_id:
+                return (404, error_body(404, "notFound", "Not Found"), {})
+            records = [
+                record
+                for record in mailbox.history
+                if int(record["id"]) > start_history_id
+            ]
+            max_results = int(param("maxResults", 100))
+            offset = int(param("pageToken") or 0)
+            response = {
+                "history": records[offset : offset + max_results],
+                "historyId": str(mailbox.history_id),
+            }
+            if offset + max_results < len(records):
+                response["nextPageToken"] = str(offset + max_results)
+            return (200, response, {})
+        if method == "GET" and path == "labels":
+            return (200, {"labels": list(mailbox.labels.values())}, {})
+        if method == "POST" and path == "labels":
+            return (200, mailbox.create_label(body["name"]), {})
+        return (404, error_body(404, "notFound", "Not Found"), {})
+
+
+def parse_http_request(data):
+    # Request of a batch part: request line, headers and body
+    (head, _, body) = data.replace(b"\r\n", b"\n").partition(b"\n\n")
+    request_line = head.split(b"\n", 1)[0].decode()
+    (method, url, _) = request_line.split(" ", 2)
+    return (method, url, json.loads(body) if body.strip() else None)
+
+
+def http_response(status, body, headers):
+    lines = [f"HTTP/1.1 {status} {http_reason(status)}"]
+    lines.append("Content-Type: application/json; charset=UTF-8")
+    lines.extend(f"{name}: {value}" for name, value in headers.items())
+    content = json.dumps(body) if body is not None else ""
+    return "\r\n".join(lines) + "\r\n\r\n" + content
+
+
+def http_reason(status):
+    return {
+        200: "OK",
+        204: "No Content",
+        403: "Forbidden",
+        404: "Not Found",
+        429: "Too Many Requests",
+        500: "Internal Server Error",
+        503: "Service Unavailable",
+    }.get(status, "Unknown")
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, with Nagle's algorithm
+    # the body waits for the delayed ACK of the headers (~40 ms)
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def __read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def __send(self, status, content, content_type, headers=None):
+        content = content.encode() if isinstance(content, str) else content
+        accept_encoding = self.headers.get("Accept-Encoding", "")
+        compressed = "gzip" in accept_encoding and len(content) >= (
+            GZIP_MIN_SIZE
+        )
+        if compressed:
+            content = gzip.compress(content, compresslevel=1)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        if compressed:
+            self.send_header("Content-Encoding", "gzip")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+        self.server.count("bytes_sent", None, len(content))
+
+    def __send_json(self, status, body, headers=None):
+        self.__send(
+            status,
+            json.dumps(body) if body is not None else "",
+            "application/json; charset=UTF-8",
+            headers,
+        )
+
+    def __handle(self, method):
+        self.server.count("http_requests", None)
+        body = self.__read_body()
+        path = urlsplit(self.path).path
+        if path.startswith("/_admin/"):
+            self.__admin(path[len("/_admin/") :], body)
+        elif path in BATCH_PATHS and method == "POST":
+            self.__batch(body)
+        else:
+            (status, response, headers) = self.server.dispatch(
+                method, self.path, json.loads(body) if body else None
+            )
+            self.__send_json(status, response, headers)
+
+    def __admin(self, command, body):
+        server = self.server
+        if command == "stats":
+            with server.stats_lock:
+                stats = json.loads(json.dumps(server.stats))
+            self.__send_json(200, stats)
+        elif command == "reset":
+            server.reset_stats()
+            self.__send_json(200, {})
+        elif command == "mutate":
+            with server.mailbox.lock:
+                server.mailbox.mutate(**json.loads(body or b"{}"))
+                self.__send_json(200, {"historyId": server.mailbox.history_id})
+        else:
+            self.__send_json(404, {})
+
+    def __batch(self, body):
+        # Parse multipart request (the content type header holds the
+        # boundary) and answer each part in the same order
+        message = BytesParser().parsebytes(
+            f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode()
+            + body
+        )
+        boundary = f"batch_{random.getrandbits(64):016x}"
+        parts = []
+        for part in message.get_payload():
+            (method, url, request_body) = parse_http_request(
+                part.get_payload(decode=True)
+            )
+            (status, response, headers) = self.server.dispatch(
+                method, url, request_body
+            )
+            content_id = part["Content-ID"].strip("<>")
+            parts.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id}>\r\n\r\n"
+                + http_response(status, response, headers)
+                + "\r\n"
+            )
+        parts.append(f"--{boundary}--\r\n")
+        self.__send(
+            200, "".join(parts), f"multipart/mixed; boundary={boundary}"
+        )
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self.__handle("GET")
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        self.__handle("POST")
+
+
+def main():
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8080
+    print(f"Generate mailbox with {num_messages} messages ...")
+    server = Server(Mailbox(num_messages), port)
+    print(f"Serve Gmail API stand-in at {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print()
+
+
+if __name__ == "__main__":
+    main()
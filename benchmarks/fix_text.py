@@ -0,0 +1,96 @@
+"""Micro-benchmark of text repair during message download
+
+Compares repairing every string of every 'messages.get' response (as
+done before) with repairing only the displayed or matched fields when
+they are read. Run from the project directory:
+
+    python -m benchmarks.fix_text [NUM_MESSAGES]
+"""
+import html
+import random
+import sys
+import time
+
+import ftfy
+
+from gmail.message import Message
+
+SENDERS = [
+    "Example Shop <news@info.example.com>",
+    "noreply@accounts.example.org",
+    '"Müller, Jörg" <joerg@beispiel.de>',
+    "Caf&eacute; Rouge <hello@cafe-rouge.fr>",
+]
+
+SNIPPETS = [
+    "Your order has shipped and will arrive on Monday",
+    "Don&#39;t miss our weekly deals &amp; offers",
+    "Grüße aus Berlin, anbei die Unterlagen",
+]
+
+
+def __response(index):
+    return {
+        "id": f"{index:016x}",
+        "threadId": f"{index:016x}",
+        "labelIds": ["INBOX", "UNREAD", "CATEGORY_PROMOTIONS", "Label_42"],
+        "snippet": random.choice(SNIPPETS),
+        "payload": {
+            "partId": "",
+            "mimeType": "multipart/alternative",
+            "headers": [
+                {"name": "From", "value": random.choice(SENDERS)},
+                {"name": "Subject", "value": random.choice(SNIPPETS)},
+            ],
+        },
+        "sizeEstimate": random.randint(1000, 100000),
+        "historyId": str(random.randint(10**6, 10**7)),
+        "internalDate": str(random.randint(10**12, 2 * 10**12)),
+    }
+
+
+def __fix_all_strings(obj):
+    # Previous behavior: every string of every response is repaired
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            obj[key] = __fix_all_strings(value)
+    elif isinstance(obj, list):
+        for index, value in enumerate(obj):
+            obj[index] = __fix_all_strings(value)
+    elif isinstance(obj, str):
+        obj = ftfy.fix_text(html.unescape(obj))
+    return obj
+
+
+def __eager(responses):
+    for response in responses:
+        _ = Message.from_response(__fix_all_strings(response)).raw_sender
+
+
+def __lazy(responses):
+    for response in responses:
+        # Analysis only reads the sender of each message
+        _ = Message.from_response(response).sender
+
+
+def __measure(func, responses):
+    start = time.process_time()
+    func(responses)
+    return time.process_time() - start
+
+
+def main():
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    random.seed(0)
+    eager_time = __measure(
+        __eager, [__response(i) for i in range(num_messages)]
+    )
+    lazy_time = __measure(__lazy, [__response(i) for i in range(num_messages)])
+    print(f"{num_messages} messages")
+    print(f"repair all strings:     {eager_time:.3f}s CPU")
+    print(f"repair fields on read:  {lazy_time:.3f}s CPU")
+    print(f"reduction:              {eager_time / lazy_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
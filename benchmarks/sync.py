@@ -0,0 +1,249 @@
+"""End-to-end benchmark of synchronization and sorting
+
+Serves a synthetic mailbox with the Gmail API stand-in (in a separate
+process, so that it does not count towards the memory of the client)
+and measures an initial synchronization, an incremental synchronization
+after random changes and sorting all messages into labels matching
+their sender domains. Run from the project directory:
+
+    python -m benchmarks.sync [OPTIONS]
+
+Reports messages per second, HTTP requests, API calls, injected errors
+and peak RSS of each phase. Each phase runs in a process of its own,
+the phases only share the local database.
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from urllib.request import Request, urlopen
+
+from benchmarks import fakegmail
+from gmail import gmail, gmail_api, quota
+
+
+class FakeCredentials:
+    """Always valid credentials accepted by the stand-in"""
+
+    token = "benchmark"
+    valid = True
+
+    def refresh(self, request):
+        pass
+
+
+def serve(options, urls):
+    mailbox = fakegmail.Mailbox(options.messages, options.domains)
+    server = fakegmail.Server(
+        mailbox,
+        latency=options.latency,
+        quota_error_rate=options.quota_errors,
+        backend_error_rate=options.backend_errors,
+    )
+    urls.put(server.url)
+    server.serve_forever()
+
+
+def __admin(url, command, body=None):
+    data = json.dumps(body).encode() if body is not None else None
+    request = Request(f"{url}_admin/{command}", data=data)
+    with urlopen(request) as response:
+        return json.load(response)
+
+
+def __create_client(options, url, profile_dir):
+    gmail.PROFILE_DIR = profile_dir
+    return gmail_api.Client(
+        FakeCredentials(),
+        os.path.join(profile_dir, "benchmark"),
+        scheduler=quota.Scheduler(rate=options.quota_rate),
+        root_url=url,
+    )
+
+
+def __synchronize(client, options):
+    (userdata, err) = gmail.synchronize(client, "benchmark", options.engine)
+    if err:
+        sys.exit("Synchronization failed")
+    return userdata
+
+
+def __mutate(_client, options, url):
+    __admin(
+        url,
+        "mutate",
+        {
+            "add": options.changes,
+            "modify": options.changes,
+            "delete": options.changes,
+        },
+    )
+
+
+def __load(client, options, _url):
+    return __synchronize(client, options)
+
+
+def __initial_sync(client, options, _state):
+    return len(__synchronize(client, options).messages)
+
+
+def __incremental_sync(client, options, _state):
+    __synchronize(client, options)
+    return 3 * options.changes
+
+
+def __sort(client, _options, userdata):
+    domains = gmail.partition_messages_by_sender_domain(userdata, None)
+    found_labels = gmail.find_labels_by_suffix(
+        userdata, domains.keys(), "Sorted"
+    )
+    sorts = gmail.get_sorts(userdata, domains, found_labels)
+    plan = gmail.plan_sort(userdata, sorts, None)
+    if not gmail.execute_sort_plan(client, plan):
+        sys.exit("Sorting failed")
+    return sum(map(len, plan.values()))
+
+
+# Phases in order: name, preparation (not measured, e.g., changing the
+# mailbox or loading the local database) and measured function
+PHASES = [
+    ("initial sync", None, __initial_sync),
+    ("incremental sync", __mutate, __incremental_sync),
+    ("sort", __load, __sort),
+]
+
+
+def __run_phase(options, url, profile_dir, index, results):
+    # Runs in a process of its own, so that the peak RSS only covers a
+    # single phase (state is passed on by the local database)
+    (name, prepare, func) = PHASES[index]
+    client = __create_client(options, url, profile_dir)
+    output = io.StringIO()
+    with contextlib.ExitStack() as stack:
+        stack.callback(client.close)
+        if not options.verbose:
+            stack.enter_context(contextlib.redirect_stdout(output))
+            stack.enter_context(contextlib.redirect_stderr(output))
+        state = prepare(client, options, url) if prepare else None
+        __admin(url, "reset", {})
+        start = time.perf_counter()
+        num_messages = func(client, options, state)
+        seconds = time.perf_counter() - start
+    stats = __admin(url, "stats")
+    results.put(
+        {
+            "phase": name,
+            "seconds": round(seconds, 3),
+            "messages": num_messages,
+            "messages_per_sec": round(num_messages / seconds, 1),
+            "http_requests": stats["http_requests"],
+            "api_calls": sum(stats["api_calls"].values()),
+            "injected_errors": sum(stats["errors"].values()),
+            "bytes_received": stats["bytes_sent"],
+            # Maximum resident set size of the phase process (KiB on
+            # Linux)
+            "peak_rss_mb": round(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+            ),
+        }
+    )
+
+
+def __parse_args():
+    parser = argparse.ArgumentParser(
+        description="End-to-end benchmark against the Gmail API stand-in"
+    )
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument(
+        "--domains",
+        type=int,
+        help="number of sender domains (default: messages / 50)",
+    )
+    parser.add_argument(
+        "--changes",
+        type=int,
+        help=(
+            "messages added, modified and deleted each before the"
+            " incremental synchronization (default: messages / 100)"
+        ),
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds per API call"
+    )
+    parser.add_argument(
+        "--quota-errors",
+        type=float,
+        default=0.0,
+        help="rate of API calls failing with 403/429",
+    )
+    parser.add_argument(
+        "--backend-errors",
+        type=float,
+        default=0.0,
+        help="rate of API calls failing with 5xx",
+    )
+    parser.add_argument(
+        "--quota-rate",
+        type=float,
+        default=100000,
+        help="quota units per second of the client (Gmail: 250)",
+    )
+    parser.add_argument(
+        "--engine", choices=sorted(gmail.ENGINES.keys()), default="thread"
+    )
+    parser.add_argument("--json", metavar="FILE", help="write results to FILE")
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="show client output"
+    )
+    return parser.parse_args()
+
+
+def main():
+    options = __parse_args()
+    if options.changes is None:
+        options.changes = max(1, options.messages // 100)
+    print(f"Generate mailbox with {options.messages} messages ...")
+    urls = multiprocessing.Queue()
+    server = multiprocessing.Process(
+        target=serve, args=(options, urls), daemon=True
+    )
+    server.start()
+    url = urls.get()
+
+    profile_dir = tempfile.mkdtemp(prefix="gmailsort-benchmark-")
+    # Phase processes are spawned, since forked processes would start
+    # with the peak RSS of this process
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    results = []
+    for index, (name, _, _) in enumerate(PHASES):
+        print(f"Run {name} ...")
+        process = context.Process(
+            target=__run_phase, args=(options, url, profile_dir, index, queue)
+        )
+        process.start()
+        process.join()
+        if process.exitcode:
+            server.terminate()
+            sys.exit(f"Phase '{name}' failed")
+        results.append(queue.get())
+    server.terminate()
+
+    columns = list(results[0].keys())
+    print(" | ".join(f"{column:>16}" for column in columns))
+    for result in results:
+        print(" | ".join(f"{result[column]:>16}" for column in columns))
+    if options.json:
+        with open(options.json, "w", encoding="utf-8") as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Extraction of sender addresses and domains from From headers
+
+Domain names are extracted offline using the public suffix list snapshot
+bundled with tldextract. Results are kept in a bounded LRU cache, which
+can be persisted in the profile dir.
+"""
+import json
+import os
+import re
+import sys
+from collections import OrderedDict
+from json.decoder import JSONDecodeError
+from threading import Lock
+
+import tldextract
+
+from . import file_utils
+
+# Maximum number of cached domain names
+MAX_CACHED_DOMAINS = 100000
+
+# File name of the persisted cache in the profile dir
+CACHE_FILE = "domains.json"
+
+# Never fetches the public suffix list over the network
+__extract = tldextract.TLDExtract(suffix_list_urls=(), cache_dir=None)
+
+# Domain names by fully qualified domain names (least recently used
+# first), shared by the download threads
+__cache = OrderedDict()
+__cache_lock = Lock()
+__cache_modified = [False]
+
+
+def get_sender_address(sender):
+    from_value = sender.lower()
+    # First, check for email addresses in angle brackets
+    match = re.findall("<([^<>]*@[^<>]*)>", from_value)
+    if match:
+        return match[-1]
+
+    # Second, check for regular email addresses
+    match = re.findall("[^<>]*@[^<>]*", from_value)
+    if match:
+        return match[-1]
+
+    return ""
+
+
+def get_domain(fq_domain):
+    # Extract domain name (name@info.[example].com)
+    with __cache_lock:
+        domain = __cache.get(fq_domain)
+        if domain is not None:
+            __cache.move_to_end(fq_domain)
+            return domain
+    domain = __extract(fq_domain).domain
+    with __cache_lock:
+        __cache[fq_domain] = domain
+        if len(__cache) > MAX_CACHED_DOMAINS:
+            __cache.popitem(last=False)
+        __cache_modified[0] = True
+    return domain
+
+
+def load_cache(profile_path):
+    cache_path = os.path.join(profile_path, CACHE_FILE)
+    try:
+        with open(cache_path, encoding="utf-8") as cache_file:
+            entries = json.load(cache_file)
+    except FileNotFoundError:
+        return
+    except (OSError, JSONDecodeError) as err:
+        print(f"Cannot load domain cache, ignore [{cache_path}]: {err}")
+        return
+    with __cache_lock:
+        __cache.clear()
+        for fq_domain, domain in entries[-MAX_CACHED_DOMAINS:]:
+            __cache[sys.intern(fq_domain)] = sys.intern(domain)
+        __cache_modified[0] = False
+
+
+def save_cache(profile_path):
+    with __cache_lock:
+        if not __cache_modified[0]:
+            return
+        entries = list(__cache.items())
+        __cache_modified[0] = False
+    cache_path = os.path.join(profile_path, CACHE_FILE)
+    file_utils.write_json(cache_path, entries)
+
+
+def get_sender_domains(sender):
+    """Returns sender address, fully qualified domain and domain name
+
+    All values are empty if the sender contains no email address.
+    """
+    sender_address = get_sender_address(sender)
+    if not sender_address:
+        return ("", "", "")
+    # Extract fully qualified domain name (name@[info.example.com])
+    fq_domain = sys.intern(sender_address.split("@")[-1])
+    return (sender_address, fq_domain, sys.intern(get_domain(fq_domain)))
@@ -0,0 +1,14 @@
+import json
+import os
+
+
+def write_json(path, data):
+    """Writes data as JSON to a file, creating its directory if needed
+
+    The file is replaced at once, so it is never left incomplete.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as json_file:
+        json.dump(data, json_file, ensure_ascii=False)
+    os.replace(tmp_path, path)
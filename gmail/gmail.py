@@ -1,346 +1,947 @@
 import json
 import os
 import pickle
-import re
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack, redirect_stderr, redirect_stdout
 from json.decoder import JSONDecodeError
 
-import tldextract
-
-from . import gmail_api
+from . import domains, gmail_api, gmail_async, push, rules, store
+from .labels import LabelIndex
+from .message import Message
+from .metrics import Report
 
 
 # pylint: disable=too-few-public-methods
 class UserData:
-    def __init__(self, messages=None, history_id=None, labels=None):
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        messages=None,
+        history_id=None,
+        labels=None,
+        label_message_ids=None,
+        domain_message_ids=None,
+    ):
         self.messages = messages or {}
         self.history_id = history_id or 0
         self.labels = labels or {}
+        self.__label_message_ids = label_message_ids
+        self.__domain_message_ids = domain_message_ids
+        self.__label_index = None
+
+    @property
+    def label_index(self):
+        # Built once per labels dict
+        if self.__label_index is None or self.__label_index.labels is not (
+            self.labels
+        ):
+            self.__label_index = LabelIndex(self.labels)
+        return self.__label_index
+
+    @property
+    def label_message_ids(self):
+        # Inverted index from label ids to message ids, built from the
+        # messages if not loaded from the store
+        if self.__label_message_ids is None:
+            self.__label_message_ids = {}
+            for message in self.messages.values():
+                for label_id in message.label_ids:
+                    self.__label_message_ids.setdefault(label_id, set()).add(
+                        message.id
+                    )
+        return self.__label_message_ids
+
+    @property
+    def domain_message_ids(self):
+        # Message ids by domain and fully qualified domain, built from the
+        # messages if not loaded from the store
+        if self.__domain_message_ids is None:
+            self.__domain_message_ids = {}
+            for message in self.messages.values():
+                self.__domain_message_ids.setdefault(
+                    message.domain, {}
+                ).setdefault(message.fq_domain, set()).add(message.id)
+        return self.__domain_message_ids
+
+    def update_messages(self, messages, deleted_ids):
+        """Upserts and deletes messages, indexes already built are updated
+        accordingly instead of being rebuilt
+        """
+        # Deletions win like in the store
+        deleted_ids = set(deleted_ids)
+        messages = {
+            msg.id: msg for msg in messages if msg.id not in deleted_ids
+        }
+        for msg_id in deleted_ids.union(messages):
+            message = self.messages.pop(msg_id, None)
+            if message is not None:
+                self.__index_message(message, remove=True)
+        for message in messages.values():
+            self.messages[message.id] = message
+            self.__index_message(message)
+
+    def __index_message(self, message, remove=False):
+        index_sets = []
+        if self.__label_message_ids is not None:
+            index_sets.extend(
+                (self.__label_message_ids, label_id)
+                for label_id in message.label_ids
+            )
+        if self.__domain_message_ids is not None:
+            index_sets.append(
+                (
+                    self.__domain_message_ids.setdefault(message.domain, {}),
+                    message.fq_domain,
+                )
+            )
+        for index, key in index_sets:
+            if remove:
+                msg_ids = index.get(key, set())
+                msg_ids.discard(message.id)
+                if not msg_ids:
+                    index.pop(key, None)
+            else:
+                index.setdefault(key, set()).add(message.id)
+        # Drop domains left without fully qualified domains
+        if self.__domain_message_ids is not None and not (
+            self.__domain_message_ids[message.domain]
+        ):
+            del self.__domain_message_ids[message.domain]
 
 
 PROFILE_DIR = ".profiles"
 
+# File name of the output of a profile synchronized in a worker process
+# (stored in profile dir)
+SYNC_LOG_FILE = "sync.log"
+
+# Default time in seconds between two polls of the history when watching
+# a profile
+WATCH_INTERVAL = 60
+
+# Messages with these labels are never analyzed or sorted
+EXCLUDED_LABEL_NAMES = ["DRAFT", "SENT", "CHAT"]
+
 
 def get_profile_dir(profile_name=""):
     return os.path.join(PROFILE_DIR, profile_name)
 
 
-def authenticate(profile_name, credentials_file):
+def get_profile_names():
+    # Profiles are subdirectories of the profile dir with a stored token
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    return sorted(
+        name
+        for name in os.listdir(PROFILE_DIR)
+        if os.path.isfile(os.path.join(PROFILE_DIR, name, "token.json"))
+    )
+
+
+def authenticate(profile_name, credentials_file, interactive=True):
     profile_path = os.path.join(PROFILE_DIR, profile_name)
     token_path = os.path.join(profile_path, "token.json")
-    return gmail_api.authenticate(token_path, credentials_file)
+    return gmail_api.authenticate(token_path, credentials_file, interactive)
 
 
-def synchronize(creds, profile_name):
-    profile_path = os.path.join(PROFILE_DIR, profile_name)
+# Engines for downloading message data and history items
+ENGINES = {"thread": gmail_api, "async": gmail_async}
+
+
+def __migrate_pickle(profile_path, db):
+    # Profiles created by older versions store all userdata in a single
+    # pickle file, which is imported once into the store
     userdata_path = os.path.join(profile_path, "userdata.pickle")
-    print(f"Synchronize local database with Gmail [{userdata_path}]")
-    (profile, err) = gmail_api.get_profile(creds)
-    if err:
-        return (UserData(), True)
-    history_id = profile["historyId"]
+    if not os.path.exists(userdata_path) or int(db.history_id):
+        return
+    print(f"Migrate local database [{userdata_path}]")
+    with open(userdata_path, "rb") as data:
+        userdata = pickle.load(data)
+    db.update(
+        map(Message.from_response, userdata.messages.values()),
+        [],
+        userdata.history_id,
+    )
+    os.replace(userdata_path, userdata_path + ".bak")
+
 
-    # Load userdata for profile (messages, history_id)
-    if os.path.exists(userdata_path):
-        with open(userdata_path, "rb") as data:
-            userdata = pickle.load(data)
+def synchronize(client, profile_name, engine="thread"):
+    profile_path = os.path.join(PROFILE_DIR, profile_name)
+    domains.load_cache(profile_path)
+    try:
+        with store.open_store(profile_path) as db:
+            print(f"Synchronize local database with Gmail [{db.path}]")
+            __migrate_pickle(profile_path, db)
+            result = __synchronize(client, ENGINES[engine], db)
+    finally:
+        domains.save_cache(profile_path)
+    stats = client.connection_stats
+    print(
+        f"Sent {stats.requests} requests over {stats.connections} connections"
+        f" ({stats.reused} reused)"
+    )
+    return result
 
-        # Fetch history difference from last sync
-        if history_id > userdata.history_id:
-            (history_items, err) = gmail_api.get_history_items(
-                creds, userdata.history_id
+
+def sync_profile(profile_dir, profile_name, credentials_file, engine="thread"):
+    """Authenticates and synchronizes a single profile in a worker process
+
+    Output is written to the log file of the profile. Returns the run
+    report of the profile with its number of messages and error (if any).
+    """
+    # The profile dir is passed explicitly, since worker processes do not
+    # necessarily inherit module state
+    global PROFILE_DIR  # pylint: disable=global-statement
+    PROFILE_DIR = profile_dir
+    profile_path = os.path.join(PROFILE_DIR, profile_name)
+    report = Report(None, "sync", profile_name)
+    num_messages = 0
+    error = None
+    with ExitStack() as stack:
+        # Any failure only skips this profile, also if its log file cannot
+        # be written (the traceback is printed to the terminal then)
+        try:
+            log_file = stack.enter_context(
+                open(
+                    os.path.join(profile_path, SYNC_LOG_FILE),
+                    "w",
+                    encoding="utf-8",
+                )
+            )
+            stack.enter_context(redirect_stdout(log_file))
+            stack.enter_context(redirect_stderr(log_file))
+            report.start_phase("authentication")
+            (client, err) = authenticate(
+                profile_name, credentials_file, interactive=False
             )
             if err:
-                return (UserData(), True)
-            messages_updated_ids = set()
-            messages_deleted_ids = set()
-
-            def get_message_id(msg):
-                return msg["message"]["id"]
-
-            for history_item in history_items:
-                messages_updated_ids.update(
-                    set(
-                        map(
-                            get_message_id,
-                            history_item.get("messagesAdded", []),
-                        )
-                    )
-                )
-                messages_updated_ids.update(
-                    set(
-                        map(get_message_id, history_item.get("labelsAdded", []))
-                    )
-                )
-                messages_updated_ids.update(
-                    set(
-                        map(
-                            get_message_id,
-                            history_item.get("labelsRemoved", []),
-                        )
-                    )
+                error = "authentication failed"
+            else:
+                report.client = client
+                # Worker processes are reused for further profiles
+                stack.callback(client.close)
+                report.start_phase("sync")
+                (userdata, err) = synchronize(client, profile_name, engine)
+                if err:
+                    error = "synchronization failed"
+                num_messages = len(userdata.messages)
+        except Exception as err:  # pylint: disable=broad-except
+            traceback.print_exc()
+            error = f"{type(err).__name__}: {err}"
+        report.start_phase(None)
+    return dict(
+        report.to_dict(error is None), messages=num_messages, error=error
+    )
+
+
+def sync_profiles(profile_names, credentials_file, engine="thread", jobs=None):
+    """Synchronizes profiles concurrently in a process pool
+
+    Each profile has its own client and thus its own quota budget (Gmail
+    quotas are per user). Failing profiles are skipped. Returns the
+    reports of all profiles.
+    """
+    print(
+        f"Synchronize {len(profile_names)} profiles with Gmail [{PROFILE_DIR}]"
+    )
+    reports = {}
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {
+            pool.submit(
+                sync_profile, PROFILE_DIR, name, credentials_file, engine
+            ): name
+            for name in profile_names
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                reports[name] = future.result()
+            # Worker process died (e.g., killed due to lack of memory) or
+            # its report could not be returned, only skip this profile
+            except Exception as err:  # pylint: disable=broad-except
+                reports[name] = {
+                    "profile": name,
+                    "success": False,
+                    "messages": 0,
+                    "error": f"worker process failed: {err!r}",
+                }
+            report = reports[name]
+            if report["success"]:
+                print(
+                    f"[{name}] {report['messages']} messages synchronized"
+                    f" in {report['seconds']}s"
                 )
-                messages_deleted_ids.update(
-                    set(
-                        map(
-                            get_message_id,
-                            history_item.get("messagesDeleted", []),
-                        )
-                    )
+            else:
+                log_path = os.path.join(PROFILE_DIR, name, SYNC_LOG_FILE)
+                print(f"[{name}] skipped: {report['error']} [{log_path}]")
+
+    reports = [reports[name] for name in profile_names]
+    failed = [report["profile"] for report in reports if not report["success"]]
+    print(
+        f"{len(reports) - len(failed)} of {len(reports)} profiles"
+        f" synchronized, {sum(report['messages'] for report in reports)}"
+        " messages in total"
+    )
+    if failed:
+        print(f"Failed profiles: {', '.join(failed)}")
+    return reports
+
+
+class Watcher:
+    """State of a watched profile between polls
+
+    User data and its indexes are kept in memory and only updated by the
+    changes of each poll of the history (see 'update'). Messages arriving
+    in a poll are sorted like by the find command (see 'get_sorts').
+    """
+
+    def __init__(self, client, api, db, userdata, options):
+        self.client = client
+        self.api = api
+        self.db = db
+        self.userdata = userdata
+        # Options of 'watch': source and destination label names, rule
+        # table and whether to sort messages (or only plan sorting)
+        self.options = options
+        # Messages not known before, which have not been deleted in the
+        # meantime
+        self.new_messages = {}
+
+    def update(self, messages, deleted_ids):
+        for message in messages:
+            if (
+                message.id not in self.userdata.messages
+                or message.id in self.new_messages
+            ):
+                self.new_messages[message.id] = message
+        for msg_id in deleted_ids:
+            self.new_messages.pop(msg_id, None)
+        self.userdata.update_messages(messages, deleted_ids)
+
+    def sort_new_messages(self):
+        """Sorts the new messages, returns the number of sorted messages"""
+        if not self.new_messages:
+            return 0
+        # Labels are only fetched if there is something to sort
+        (labels, err) = gmail_api.get_labels(self.client)
+        if not err:
+            self.db.set_labels(labels)
+            self.userdata.labels = self.db.get_labels()
+
+        options = self.options
+        partition = partition_messages_by_sender_domain(
+            self.userdata, options["src_label_name"], self.new_messages.keys()
+        )
+        found_labels = find_labels_by_suffix(
+            self.userdata, partition.keys(), options["dst_label_name"]
+        )
+        sorts = get_sorts(
+            self.userdata,
+            partition,
+            found_labels,
+            options["rule_table"],
+            options["src_label_name"],
+        )
+        plan = plan_sort(self.userdata, sorts, options["src_label_name"])
+        if not plan:
+            return 0
+        print_sort_plan(self.userdata, plan)
+        if options["sort_messages"] and execute_sort_plan(self.client, plan):
+            return sum(map(len, plan.values()))
+        return 0
+
+
+def watch(  # pylint: disable=too-many-arguments
+    client,
+    profile_name,
+    engine="thread",
+    src_label_name=None,
+    dst_label_name=None,
+    interval=WATCH_INTERVAL,
+    sort_messages=False,
+    push_port=None,
+    rule_table=None,
+):
+    """Keeps a profile synchronized and sorts newly arrived messages
+
+    New messages are sorted into the single label matching their sender
+    domain, or into the label of the most specific rule of the optional
+    rule table (only planned unless 'sort_messages' is set). With a push
+    port, push notifications trigger a poll before the interval has
+    passed. Runs until interrupted, returns False if the initial
+    synchronization failed or the source or destination label does not
+    exist.
+    """
+    api = ENGINES[engine]
+    profile_path = os.path.join(PROFILE_DIR, profile_name)
+    domains.load_cache(profile_path)
+    try:
+        with store.open_store(profile_path) as db, ExitStack() as stack:
+            print(f"Synchronize local database with Gmail [{db.path}]")
+            __migrate_pickle(profile_path, db)
+            (userdata, err) = __synchronize(client, api, db)
+            if err:
+                return False
+            # Both labels must exist to sort messages
+            for label_name in [src_label_name, dst_label_name]:
+                if label_name and not label_exists(userdata, label_name):
+                    print(f"Label '{label_name}' does not exist")
+                    return False
+
+            wait = time.sleep
+            if push_port is not None:
+                listener = stack.enter_context(push.PushListener(push_port))
+                print(
+                    "Listen for push notifications on port"
+                    f" {listener.server_address[1]}"
                 )
-            # Do not fetch messages that will be deleted anyway
-            messages_updated_ids = messages_updated_ids.difference(
-                messages_deleted_ids
+                wait = listener.wait
+
+            watcher = Watcher(
+                client,
+                api,
+                db,
+                userdata,
+                {
+                    "src_label_name": src_label_name,
+                    "dst_label_name": dst_label_name,
+                    "rule_table": rule_table,
+                    "sort_messages": sort_messages,
+                },
             )
-            (messages_updated, err) = gmail_api.get_messages(
-                creds, messages_updated_ids
-            )
-            if err:
-                return (UserData(), True)
-            for message in messages_updated:
-                userdata.messages[message["id"]] = message
-            for message_id in messages_deleted_ids:
-                # SPAM or TRASH messages are not stored in userdata, but
-                # can occur in history items
-                if message_id in userdata.messages:
-                    del userdata.messages[message_id]
-            userdata.history_id = history_id
+            print(f"Watch for new messages every {interval}s")
+            while True:
+                wait(interval)
+                # Changes applied before a connection failure are kept
+                # (store and user data are updated page by page), the
+                # remaining ones are fetched by the next poll
+                try:
+                    __poll(watcher)
+                except gmail_api.NETWORK_ERRORS as err:
+                    print(f"Connection error: {err}, retry with next poll")
+    finally:
+        domains.save_cache(profile_path)
+
+
+def __poll(watcher):
+    # Applies the changes since the last poll and sorts new messages
+    start = time.perf_counter()
+    (profile, err) = gmail_api.get_profile(watcher.client)
+    if err or int(profile["historyId"]) <= int(watcher.db.history_id):
+        return
+
+    watcher.new_messages.clear()
+    synchronized = __synchronize_history(
+        watcher.client,
+        watcher.api,
+        watcher.db,
+        profile["historyId"],
+        watcher.update,
+    )
+    watcher.userdata.history_id = watcher.db.history_id
+    if not synchronized:
+        print("Synchronization failed, retry with next poll")
+
+    num_sorted = watcher.sort_new_messages()
+    print(
+        f"{len(watcher.new_messages)} new messages, {num_sorted} sorted"
+        f" ({(time.perf_counter() - start) * 1000:.0f} ms)"
+    )
 
-    else:
-        print(
-            "No local database found: download all messages from Gmail [create"
-            f" '{userdata_path}']"
+
+def __synchronize(client, api, db):
+    (profile, err) = gmail_api.get_profile(client)
+    if err:
+        return (UserData(), True)
+    history_id = profile["historyId"]
+
+    # Download all messages on first synchronization or resume an
+    # interrupted download (checkpoints are stored during the download,
+    # so only messages not stored yet are downloaded again)
+    if not int(db.history_id):
+        if not db.download_history_id:
+            print("No local database found: download all messages from Gmail")
+            # Changes made during the download are fetched afterwards from
+            # the history starting at the current history id
+            db.start_download(history_id)
+        else:
+            print("Resume interrupted download of all messages from Gmail")
+        (_, err) = api.get_all_messages(
+            client, db.get_message_ids(), callback=db.add_messages
         )
-        # Fetch messages and history_id from remote
-        (message_ids, err) = gmail_api.get_message_ids(creds)
         if err:
             return (UserData(), True)
-        (messages, err) = gmail_api.get_messages(creds, message_ids)
+        db.finish_download()
+        # Replay changes made during the download (which may take hours)
+        # up to the current history id
+        (profile, err) = gmail_api.get_profile(client)
         if err:
             return (UserData(), True)
-        messages = dict(map(lambda msg: (msg["id"], msg), messages))
-        userdata = UserData(messages, history_id)
+        history_id = profile["historyId"]
 
-    # Store userdata for profile
-    os.makedirs(os.path.dirname(userdata_path), exist_ok=True)
-    with open(userdata_path, "wb") as data:
-        pickle.dump(userdata, data)
+    if not __synchronize_history(client, api, db, history_id):
+        return (UserData(), True)
 
     # Always fetch labels, since changes are not reflected in history
-    (labels, err) = gmail_api.get_labels(creds)
+    (labels, err) = gmail_api.get_labels(client)
     if err:
         return (UserData(), True)
-    userdata.labels = dict(map(lambda lbl: (lbl["id"], lbl), labels))
+    db.set_labels(labels)
+
+    return (
+        UserData(
+            db.get_messages(),
+            history_id,
+            db.get_labels(),
+            db.get_label_message_ids(),
+            db.get_domain_message_ids(),
+        ),
+        False,
+    )
 
-    return (userdata, False)
 
+def __synchronize_history(client, api, db, history_id, on_update=None):
+    # Fetch history difference from last sync (or download start), the
+    # optional function 'on_update' is called with the messages and
+    # deleted ids of each update applied to the store
+    if int(history_id) <= int(db.history_id):
+        return True
+
+    def update(messages, deleted_ids, checkpoint):
+        db.update(messages, deleted_ids, checkpoint)
+        if on_update:
+            on_update(messages, deleted_ids)
+
+    def apply_history_page(history_items):
+        (
+            fetch_ids,
+            messages_patched,
+            messages_deleted_ids,
+        ) = __apply_history_items(db, history_items)
+        (messages_updated, err) = api.get_messages(client, fetch_ids)
+        if err:
+            return False
+        # Apply changes of each page in a single transaction (SPAM or
+        # TRASH messages are not stored, but can occur in history items),
+        # the last history record is the checkpoint to resume from
+        update(
+            messages_patched + messages_updated,
+            messages_deleted_ids,
+            history_items[-1]["id"] if history_items else db.history_id,
+        )
+        return True
 
-def __label_exists(label_name, labels):
-    label_name_tokens = list(filter(None, label_name.lower().split("/")))
-    for label in labels.values():
-        if label_name_tokens == list(
-            filter(None, label["name"].lower().split("/"))
-        ):
-            return True
-    return False
+    (expired, err) = api.process_history_pages(
+        client, db.history_id, apply_history_page
+    )
+    if err:
+        return False
+    if expired:
+        return __reconcile(client, api, db, history_id, update)
+    db.update([], [], history_id)
+    return True
 
 
-def __is_sublabel(label_name, sublabel_name):
-    label_tokens = list(filter(None, label_name.lower().split("/")))
-    sublabel_tokens = list(filter(None, sublabel_name.lower().split("/")))
-    if len(sublabel_tokens) < len(label_tokens):
+def __apply_history_items(db, history_items):
+    # Label changes of stored messages are applied to their label ids
+    # directly, only added messages or messages not stored yet need to be
+    # fetched. Returns the ids of messages to fetch, the patched messages
+    # and the ids of deleted messages.
+    def get_message_id(record):
+        return record["message"]["id"]
+
+    stored = db.get_messages(
+        {
+            get_message_id(record)
+            for history_item in history_items
+            for key in ("labelsAdded", "labelsRemoved")
+            for record in history_item.get(key, [])
+        }
+    )
+    fetch_ids = set()
+    patched_ids = set()
+    deleted_ids = set()
+    for history_item in history_items:
+        for record in history_item.get("messagesAdded", []):
+            msg_id = get_message_id(record)
+            fetch_ids.add(msg_id)
+            deleted_ids.discard(msg_id)
+        for key in ("labelsAdded", "labelsRemoved"):
+            for record in history_item.get(key, []):
+                msg_id = get_message_id(record)
+                # Messages fetched anyway already have their current labels
+                if msg_id in fetch_ids or msg_id not in stored:
+                    fetch_ids.add(msg_id)
+                    continue
+                if key == "labelsAdded":
+                    stored[msg_id].modify_labels(
+                        add_label_ids=record["labelIds"]
+                    )
+                else:
+                    stored[msg_id].modify_labels(
+                        remove_label_ids=record["labelIds"]
+                    )
+                patched_ids.add(msg_id)
+        for record in history_item.get("messagesDeleted", []):
+            msg_id = get_message_id(record)
+            deleted_ids.add(msg_id)
+            # Do not fetch or patch messages that are deleted anyway
+            fetch_ids.discard(msg_id)
+            patched_ids.discard(msg_id)
+    return (fetch_ids, [stored[msg_id] for msg_id in patched_ids], deleted_ids)
+
+
+def __reconcile(client, api, db, history_id, update):
+    # Fallback if the history since the last synchronization is no
+    # longer available: message ids are compared with the stored ones,
+    # only unknown messages are fetched and label ids of known messages
+    # are refreshed by listing the message ids of each label
+    print("Reconcile local database with Gmail")
+    (message_ids, err) = gmail_api.get_message_ids(client)
+    if err:
+        return False
+    message_ids = set(message_ids)
+    stored_ids = db.get_message_ids()
+    (labels, err) = gmail_api.get_labels(client)
+    if err:
+        return False
+    (label_message_ids, err) = gmail_api.get_label_message_ids(
+        client, [label["id"] for label in labels]
+    )
+    if err:
         return False
-    for index, token in enumerate(label_tokens):
-        if token != sublabel_tokens[index]:
-            return False
-    return True
 
+    # Label ids of known messages according to the label listings
+    label_ids = {}
+    for label_id, msg_ids in label_message_ids.items():
+        for msg_id in msg_ids:
+            label_ids.setdefault(msg_id, set()).add(label_id)
+    messages_patched = []
+    for message in db.get_messages(message_ids & stored_ids).values():
+        msg_label_ids = label_ids.get(message.id, set())
+        if msg_label_ids != set(message.label_ids):
+            message.modify_labels(
+                msg_label_ids.difference(message.label_ids),
+                set(message.label_ids).difference(msg_label_ids),
+            )
+            messages_patched.append(message)
 
-def __get_message_labels_by_prefix(message, labels, prefix):
-    msg_labels = []
-    for label_id in message.get("labelIds", []):
-        label = labels[label_id]
-        if prefix and __is_sublabel(prefix, label["name"]):
-            msg_labels.append(label)
-    return msg_labels
+    (messages_added, err) = api.get_messages(client, message_ids - stored_ids)
+    if err:
+        return False
+    messages_deleted_ids = stored_ids - message_ids
+    print(
+        f"Reconciliation added {len(messages_added)}, updated"
+        f" {len(messages_patched)} and deleted {len(messages_deleted_ids)}"
+        " messages"
+    )
+    update(messages_patched + messages_added, messages_deleted_ids, history_id)
+    return True
 
 
-def __include_messages(messages, labels, label_names):
-    # Filter out non-existing labels
-    tmp_label_names = []
-    for label_name in label_names:
-        if __label_exists(label_name, labels):
-            tmp_label_names.append(label_name)
-        else:
-            print(f"Label '{label_name}' does not exist, ignore")
-    label_names = tmp_label_names
-
-    # Include messages by label name (case-insensitive)
-    msgs = []
-    for message in messages:
-        for label_name in label_names:
-            if __get_message_labels_by_prefix(message, labels, label_name):
-                break
-        else:
-            continue
-        msgs.append(message)
-    return msgs
+def __get_message_labels_by_prefix(message, label_index, prefix):
+    if not prefix:
+        return []
+    label_ids = label_index.get_sublabel_ids(prefix)
+    return [
+        label_index.labels[label_id]
+        for label_id in message.label_ids
+        if label_id in label_ids
+    ]
 
 
-def __exclude_messages(messages, labels, label_names):
-    # Filter out non-existing labels
-    tmp_label_names = []
+def __get_label_ids(label_index, label_names):
+    # Ids of the labels and their sublabels (non-existing labels are
+    # filtered out)
+    label_ids = set()
     for label_name in label_names:
-        if __label_exists(label_name, labels):
-            tmp_label_names.append(label_name)
+        if label_index.exists(label_name):
+            label_ids.update(label_index.get_sublabel_ids(label_name))
         else:
             print(f"Label '{label_name}' does not exist, ignore")
-    label_names = tmp_label_names
-
-    # Exclude messages by label name (case-insensitive)
-    msgs = []
-    for message in messages:
-        for label_name in label_names:
-            if __get_message_labels_by_prefix(message, labels, label_name):
-                break
-        else:
-            msgs.append(message)
-    return msgs
-
-
-def __get_sender_address(message):
-    for header in message.get("payload", {}).get("headers", {}):
-        if header["name"].lower() == "from":
-            from_value = header["value"].lower()
-            # First, check for email addresses in angle brackets
-            match = re.findall("<([^<>]*@[^<>]*)>", from_value)
-            if match:
-                return match[-1]
+    return label_ids
 
-            # Second, check for regular email addresses
-            match = re.findall("[^<>]*@[^<>]*", from_value)
-            if match:
-                return match[-1]
 
-            break
-    return ""
+def __get_message_ids(userdata, label_names):
+    # Ids of messages with any of the labels (case-insensitive) or their
+    # sublabels
+    label_message_ids = userdata.label_message_ids
+    message_ids = set()
+    for label_id in __get_label_ids(userdata.label_index, label_names):
+        message_ids.update(label_message_ids.get(label_id, ()))
+    return message_ids
 
 
-def partition_messages_by_sender_domain(userdata, dst_label_name):
-    labels = userdata.labels
-    messages = userdata.messages.values()
+def partition_messages_by_sender_domain(
+    userdata, dst_label_name, message_ids=None
+):
+    # Partitions all messages or only the given ones (e.g., new ones)
+    # Filter out messages from draft, sent, and chats
+    excluded_ids = __get_message_ids(userdata, EXCLUDED_LABEL_NAMES)
 
     # Filter messages according to label
-    if dst_label_name:
-        messages = __include_messages(messages, labels, [dst_label_name])
+    if message_ids is not None:
+        message_ids = set(message_ids).difference(excluded_ids)
+        if dst_label_name:
+            message_ids &= __get_message_ids(userdata, [dst_label_name])
+    elif dst_label_name:
+        message_ids = __get_message_ids(userdata, [dst_label_name])
+        message_ids.difference_update(excluded_ids)
+
+    if message_ids is not None:
+        label_str = f" from '{dst_label_name}'" if dst_label_name else ""
+        print(
+            f"Analyze sender email addresses of {len(message_ids)} messages"
+            f"{label_str}"
+        )
 
-    # Filter out messages from draft, sent, and chats
-    messages = __exclude_messages(messages, labels, ["DRAFT", "SENT", "CHAT"])
+        def select(msg_ids):
+            return message_ids.intersection(msg_ids)
 
-    if dst_label_name:
+    else:
         print(
-            f"Analyze sender email addresses of {len(messages)} messages from"
-            f" '{dst_label_name}'"
+            "Analyze sender email addresses of all"
+            f" {len(userdata.messages) - len(excluded_ids)} messages"
         )
-    else:
-        print(f"Analyze sender email addresses of all {len(messages)} messages")
-
-    # Partition messages by fully qualified sender domain names
-    fq_domains = {}
-    for message in messages:
-        sender_address = __get_sender_address(message)
-        if sender_address:
-            # Extract fully qualified domain name (name@[info.example.com])
-            fq_domain = sender_address.split("@")[-1]
-            if fq_domain not in fq_domains:
-                fq_domains[fq_domain] = []
-            fq_domains[fq_domain].append(message)
-        else:
-            message_str = json.dumps(
-                message, indent=2, ensure_ascii=False, sort_keys=True
-            )
-            print(f"No sender address found in message, ignore:\n{message_str}")
 
-    # Partition fully qualified domain names by domain names
+        def select(msg_ids):
+            return msg_ids.difference(excluded_ids)
+
+    # Partition messages by domain names (name@info.[example].com) and
+    # fully qualified domain names (name@[info.example.com]), which are
+    # extracted during synchronization
     domains = {}
-    for fq_domain, messages in fq_domains.items():
-        # Extract domain name (name@info.[example].com)
-        domain = tldextract.extract(fq_domain).domain
-        if domain not in domains:
-            domains[domain] = {}
-        domains[domain][fq_domain] = messages
+    for domain, fq_domains in userdata.domain_message_ids.items():
+        for fq_domain, msg_ids in fq_domains.items():
+            msg_ids = select(msg_ids)
+            if not msg_ids:
+                continue
+            messages = [userdata.messages[msg_id] for msg_id in msg_ids]
+            if not fq_domain:
+                for message in messages:
+                    message_str = json.dumps(
+                        message.to_dict(),
+                        indent=2,
+                        ensure_ascii=False,
+                        sort_keys=True,
+                    )
+                    print(
+                        "No sender address found in message, ignore:\n"
+                        f"{message_str}"
+                    )
+                continue
+            domains.setdefault(domain, {})[fq_domain] = messages
 
     print(f"Analysis resulted in {len(domains)} sender domains")
     return domains
 
 
 def label_exists(userdata, label_name):
-    return __label_exists(label_name, userdata.labels)
+    return userdata.label_index.exists(label_name)
 
 
-def create_labels(creds, userdata, label_names):
-    labels = userdata.labels
+def create_labels(client, userdata, label_names):
+    label_index = userdata.label_index
     for label_name in label_names:
-        if __label_exists(label_name, labels):
+        if label_index.exists(label_name):
             print(f"Label '{label_name}' already exists, ignore")
         else:
-            (_, err) = gmail_api.create_label(creds, label_name)
+            (_, err) = gmail_api.create_label(client, label_name)
             if err:
                 return False
     return True
 
 
-def find_labels_by_suffix(userdata, label_names, dst_label_name):
-    labels = userdata.labels
+def find_labels_by_suffix(
+    userdata, label_names, dst_label_name, report_inexact=False
+):
+    # Inexact matches (label names only contained in last label
+    # components) are only looked for if they are reported, since this
+    # compares each label name with all last label components
+    label_index = userdata.label_index
 
-    # Filter out labels not being sublabel of the specified label
-    tmp_labels = []
-    for label in labels.values():
-        if not dst_label_name or __is_sublabel(dst_label_name, label["name"]):
-            tmp_labels.append(label)
-    labels = tmp_labels
+    # Only consider labels being sublabel of the specified label
+    if dst_label_name:
+        label_ids = label_index.get_sublabel_ids(dst_label_name)
+    else:
+        label_ids = label_index.labels.keys()
 
     found_labels = {}
     for label_name in label_names:
-        found_labels[label_name] = []
-        for label in labels:
-            # Only compare last label component
-            last_component = label["name"].lower().split("/")[-1]
-            if last_component == label_name.lower():
-                found_labels[label_name].append(label)
-            elif label_name.lower() in last_component:
-                print(
-                    f"Found unexact label match for '{label_name.lower()}':"
-                    f" '{label['name']}'"
-                )
+        # Only compare last label component
+        found_labels[label_name] = [
+            label
+            for label in label_index.get_labels_by_last_component(label_name)
+            if label["id"] in label_ids
+        ]
+        if not report_inexact:
+            continue
+        for last_component in label_index.last_components:
+            if (
+                label_name.lower() in last_component
+                and last_component != label_name.lower()
+            ):
+                for label in label_index.get_labels_by_last_component(
+                    last_component
+                ):
+                    if label["id"] in label_ids:
+                        print(
+                            "Found unexact label match for"
+                            f" '{label_name.lower()}': '{label['name']}'"
+                        )
 
     return found_labels
 
 
-def partition_messages_by_prefix(userdata, messages, dst_label_name):
-    # Create dict with label ids (strings) as keys and lists of messages
-    # as values (the empty string as key is a collector for messages
-    # with invalid label matches)
-    labels = userdata.labels
+def load_rules(profile_name, rules_file):
+    # Compiled rules are cached in the profile dir
+    return rules.load_rules(rules_file, get_profile_dir(profile_name))
+
+
+def __get_rule_label_ids(userdata, rule_table):
+    # Label ids by label names of the rules (None for labels not existing)
+    label_index = userdata.label_index
     label_ids = {}
-    for message in messages:
-        msg_labels = __get_message_labels_by_prefix(
-            message, labels, dst_label_name
-        )
-        label_id = msg_labels[0]["id"] if len(msg_labels) == 1 else ""
-        if label_id not in label_ids:
-            label_ids[label_id] = []
-        label_ids[label_id].append(message)
+    for label_name in sorted(rule_table.label_names):
+        label_ids[label_name] = label_index.get_label_id(label_name)
+        if label_ids[label_name] is None:
+            print(f"Label '{label_name}' of rules does not exist, ignore")
     return label_ids
 
 
-def modify_message_labels(creds, messages, add_label_ids, remove_label_ids):
-    message_ids = list(map(lambda msg: msg["id"], messages))
-    return gmail_api.modify_message_labels(
-        creds, message_ids, add_label_ids, remove_label_ids
+def sort_by_rules(userdata, rule_table, domains):
+    """Resolves the target labels of messages by rules
+
+    'domains' is a partition of messages as returned by
+    'partition_messages_by_sender_domain'. Returns (messages, label id)
+    pairs of messages matching a rule as sorts for 'plan_sort' and the
+    partition of the remaining messages.
+    """
+    label_ids = __get_rule_label_ids(userdata, rule_table)
+    rule_messages = {}
+    remaining = {}
+    for domain, fq_domains in domains.items():
+        for fq_domain, messages in fq_domains.items():
+            for message in messages:
+                label_name = rule_table.match(message.sender_address, fq_domain)
+                if label_name is None:
+                    remaining.setdefault(domain, {}).setdefault(
+                        fq_domain, []
+                    ).append(message)
+                elif label_ids[label_name]:
+                    rule_messages.setdefault(label_ids[label_name], []).append(
+                        message
+                    )
+    num_matched = sum(map(len, rule_messages.values()))
+    print(f"{num_matched} messages match rules of {len(rule_messages)} labels")
+    return (
+        [(messages, label_id) for label_id, messages in rule_messages.items()],
+        remaining,
+    )
+
+
+def get_sorts(
+    userdata, domains, found_labels, rule_table=None, src_label_name=None
+):
+    """Resolves the target labels of messages
+
+    'domains' is a partition of messages as returned by
+    'partition_messages_by_sender_domain' and 'found_labels' are the
+    labels found for its domains by 'find_labels_by_suffix'. Messages
+    matching a rule of the optional rule table are sorted by the rules,
+    the others into the single label found for their domain. Returns
+    (messages, label id) pairs as sorts for 'plan_sort'.
+    """
+    sorts = []
+    if rule_table:
+        (sorts, domains) = sort_by_rules(userdata, rule_table, domains)
+    for domain, fq_domains in sorted(domains.items()):
+        domain_str = f"{src_label_name}/{domain}" if src_label_name else domain
+        if len(found_labels[domain]) == 0:
+            print(f"{domain_str}: no label found, ignore")
+            continue
+
+        if len(found_labels[domain]) > 1:
+            labels = [label["name"] for label in found_labels[domain]]
+            print(
+                f"{domain_str}: multiple labels found, ignore: {sorted(labels)}"
+            )
+            continue
+
+        # Merge messages from domain into single list
+        messages = []
+        list(map(messages.extend, fq_domains.values()))
+        sorts.append((messages, found_labels[domain][0]["id"]))
+    return sorts
+
+
+def plan_sort(userdata, sorts, src_label_name):
+    """Plans label operations for sorting messages into labels
+
+    'sorts' are (messages, label id to add) pairs. A message gets the
+    label added and its single label being sublabel of the source label
+    removed. Returns dict with (label ids to add, label ids to remove)
+    tuples as keys and sets of message ids as values, i.e., messages
+    sharing identical operations are grouped. Messages already having
+    their target labels are left out.
+    """
+    label_index = userdata.label_index
+    plan = {}
+    num_sorted = 0
+    for messages, add_label_id in sorts:
+        for message in messages:
+            msg_labels = __get_message_labels_by_prefix(
+                message, label_index, src_label_name
+            )
+            # Ignore removing and adding the same label
+            remove_label_ids = ()
+            if len(msg_labels) == 1 and msg_labels[0]["id"] != add_label_id:
+                remove_label_ids = (msg_labels[0]["id"],)
+            if add_label_id in message.label_ids and not remove_label_ids:
+                num_sorted += 1
+                continue
+            plan.setdefault(((add_label_id,), remove_label_ids), set()).add(
+                message.id
+            )
+    if num_sorted:
+        print(f"{num_sorted} messages are already sorted, ignore")
+    return plan
+
+
+def print_sort_plan(userdata, plan):
+    def get_label_names(label_ids):
+        return ", ".join(
+            f"'{userdata.labels[label_id]['name']}'" for label_id in label_ids
+        )
+
+    num_messages = sum(map(len, plan.values()))
+    print(
+        f"Sort plan: modify labels of {num_messages} messages with"
+        f" {len(plan)} operations"
+    )
+    lines = []
+    for (add_label_ids, remove_label_ids), message_ids in plan.items():
+        line = f"add label {get_label_names(add_label_ids)}"
+        if remove_label_ids:
+            line += f", remove label {get_label_names(remove_label_ids)}"
+        lines.append(f"    {line}: {len(message_ids)} messages")
+    for line in sorted(lines):
+        print(line)
+
+
+def execute_sort_plan(client, plan):
+    return gmail_api.batch_modify_message_labels(
+        client,
+        [
+            (sorted(message_ids), list(add_label_ids), list(remove_label_ids))
+            for (add_label_ids, remove_label_ids), message_ids in plan.items()
+        ],
     )
 
 
-def execute(creds, line):
+def execute(client, line):
     # Parse command line
     words = line.split()
     if len(words) < 1:
@@ -367,4 +968,4 @@ def execute(creds, line):
     calls = cmd.split("_")
     if len(calls) < 1:
         return ({}, True)
-    return gmail_api.execute_api_call(creds, calls, args)
+    return gmail_api.execute_api_call(client, calls, args)
@@ -1,25 +1,30 @@
 """Convenience wrapper for the Gmail API client library"""
 from __future__ import print_function
 
-import html
+import json
 import os
 import random
 import time
+from contextlib import contextmanager
 from multiprocessing.pool import ThreadPool
-from socket import timeout
-from threading import Lock
+from queue import Queue
+from threading import Event, Lock, Thread, local
 from typing import Any, Dict
 
-import ftfy
+import httplib2
 from google.auth.exceptions import GoogleAuthError
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import V2_DISCOVERY_URI, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
 from googleapiclient.errors import HttpError
 from httplib2.error import ServerNotFoundError
 from progress.bar import Bar
 
+from . import metrics, quota, transport
+from .message import Message, fix_text
+
 # ------------------------------------------------------------------------------
 # Gmail API Python quickstart:
 # https://developers.google.com/gmail/api/quickstart/python
@@ -40,9 +45,62 @@ MAX_RESULTS = 500
 # Maximum number of messages to be processed in batch mode
 MAX_BATCH_SIZE = 1000
 
+# Maximum number of requests per HTTP batch request
+MAX_BATCH_REQUESTS = 100
+
 # Maximum number of retries for message download
 MAX_RETRIES = 10
 
+# Number of threads per thread pool of a client
+NUM_THREADS = 16
+
+# Number of messages per shard when listing message ids in parallel
+SHARD_SIZE = 5000
+
+# Maximum number of shards when listing message ids in parallel
+MAX_SHARDS = 100
+
+# Lower date limit (2004-04-01, Gmail launch) for partitioning the
+# mailbox into date ranges (older imported messages fall into the first,
+# open range)
+SHARD_START_TIME = 1080777600
+
+# Maximum number of message id chunks waiting for download
+MAX_QUEUED_CHUNKS = 4 * NUM_THREADS
+
+# Maximum number of history pages fetched ahead of processing
+MAX_QUEUED_PAGES = 4
+
+# History record types needed for synchronization
+HISTORY_TYPES = ["messageAdded", "messageDeleted", "labelAdded", "labelRemoved"]
+
+# Partial responses: fields actually used of the responses of each API
+# method (methods not listed or listed with None return complete
+# responses), extend the masks if further fields are needed
+FIELDS = {
+    "gmail.users.getProfile": "historyId,messagesTotal",
+    # Message stubs of history records are reduced to their ids
+    "gmail.users.history.list": (
+        "history(id,messagesAdded/message/id,messagesDeleted/message/id,"
+        "labelsAdded(message/id,labelIds),"
+        "labelsRemoved(message/id,labelIds)),nextPageToken"
+    ),
+    "gmail.users.labels.list": "labels(id,name,type)",
+    "gmail.users.messages.get": "id,labelIds,snippet,payload/headers",
+    "gmail.users.messages.list": "messages/id,nextPageToken",
+}
+
+# Errors of failed connections (refused, reset, timed out, or unknown
+# host), raised by the transport
+NETWORK_ERRORS = (ServerNotFoundError, OSError)
+
+# Gmail API service name and version
+API_NAME = "gmail"
+API_VERSION = "v1"
+
+# File name of the cached discovery document (stored in profile dir)
+DISCOVERY_FILE = "discovery.json"
+
 
 class MyBar(Bar):
     """Customized bar implementation"""
@@ -67,6 +125,213 @@ class MyBar(Bar):
         return self.eta - self.hours * 3600 - self.mins * 60
 
 
+class Client:
+    """Long-lived Gmail API client
+
+    The discovery document is parsed only once and cached on disk, and
+    each thread gets its own service object with its own keep-alive
+    transport, since the underlying httplib2 connection objects are not
+    thread-safe. All requests are metered by a quota scheduler shared
+    between the threads. Concurrent requests are sent by long-lived
+    thread pools of the client, so that the service objects and their
+    connections are reused across calls.
+    """
+
+    def __init__(self, creds, cache_dir, scheduler=None, root_url=None):
+        self.creds = creds
+        self.cache_dir = cache_dir
+        self.scheduler = scheduler or quota.Scheduler()
+        # Alternative API endpoint, e.g., a local stand-in for testing
+        self.root_url = root_url
+        self.connection_stats = transport.ConnectionStats()
+        self.metrics = metrics.ApiMetrics()
+        self.__discovery_doc = None
+        self.__lock = Lock()
+        self.__refresh_lock = Lock()
+        self.__local = local()
+        self.__pools = {}
+
+    def get_token(self, failed_token=None):
+        """Returns a valid access token of the credentials
+
+        The credentials are refreshed if they have expired or if the
+        failed token (rejected by Gmail) is still the current one, so
+        concurrent failures only refresh them once.
+        """
+        with self.__refresh_lock:
+            if not self.creds.valid or (
+                failed_token and failed_token == self.creds.token
+            ):
+                self.creds.refresh(Request())
+            return self.creds.token
+
+    def __load_discovery_doc(self):
+        doc_path = os.path.join(self.cache_dir, DISCOVERY_FILE)
+        if os.path.exists(doc_path):
+            with open(doc_path, "r", encoding="utf-8") as doc_file:
+                try:
+                    return json.load(doc_file)
+                except json.JSONDecodeError:
+                    # Broken cache file, fetch document again
+                    pass
+
+        # Prefer the document shipped with the client library and only
+        # fall back to downloading it
+        doc = get_static_doc(API_NAME, API_VERSION)
+        if not doc:
+            url = V2_DISCOVERY_URI.format(api=API_NAME, apiVersion=API_VERSION)
+            (resp, content) = httplib2.Http().request(url)
+            if resp.status >= 400:
+                raise HttpError(resp, content, uri=url)
+            doc = content.decode("utf-8")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(doc_path, "w", encoding="utf-8") as doc_file:
+            doc_file.write(doc)
+        return json.loads(doc)
+
+    @property
+    def discovery_doc(self):
+        with self.__lock:
+            if self.__discovery_doc is None:
+                doc = self.__load_discovery_doc()
+                if self.root_url:
+                    doc = dict(
+                        doc, rootUrl=self.root_url, baseUrl=self.root_url
+                    )
+                self.__discovery_doc = doc
+            return self.__discovery_doc
+
+    @property
+    def service(self):
+        """Service object of the calling thread"""
+        service = getattr(self.__local, "service", None)
+        if service is None:
+            self.__local.transport = transport.Transport(
+                self, self.connection_stats
+            )
+            service = build_from_document(
+                self.discovery_doc, http=self.__local.transport
+            )
+            self.__local.service = service
+        return service
+
+    def __get_pool(self, name):
+        with self.__lock:
+            pool = self.__pools.get(name)
+            if pool is None:
+                pool = ThreadPool(NUM_THREADS)
+                self.__pools[name] = pool
+            return pool
+
+    @property
+    def pool(self):
+        """Thread pool downloading and modifying messages"""
+        return self.__get_pool("pool")
+
+    @property
+    def listing_pool(self):
+        """Thread pool listing message ids
+
+        Separate from 'pool', since message ids are listed while the
+        listed messages are downloaded (see 'get_all_messages').
+        """
+        return self.__get_pool("listing")
+
+    def close(self):
+        """Stops the thread pools of the client (if any)
+
+        Tasks still queued, e.g., after an interrupt, are dropped.
+        """
+        with self.__lock:
+            pools = list(self.__pools.values())
+            self.__pools.clear()
+        for pool in pools:
+            pool.terminate()
+
+    @contextmanager
+    def __measure(self, method_id, units):
+        # Records an API call with its latency and bytes received by the
+        # transport of the calling thread, the body may set the status
+        # of failed calls
+        call = {"status": 200}
+        received = self.__local.transport.bytes_received
+        start = time.perf_counter()
+        try:
+            yield call
+        except HttpError as err:
+            call["status"] = err.status_code
+            raise
+        except NETWORK_ERRORS:
+            call["status"] = metrics.NETWORK_ERROR
+            raise
+        finally:
+            self.metrics.add_call(
+                method_id,
+                call["status"],
+                units,
+                time.perf_counter() - start,
+                self.__local.transport.bytes_received - received,
+            )
+
+    def execute(self, func):
+        # The attribute 'user' is dynamically added to the object
+        # 'service' and thus not known to pylint
+        # pylint: disable=no-member
+        request = func(self.service.users)
+        units = quota.get_quota_units(request.methodId)
+        with self.scheduler.request(units) as throttled:
+            try:
+                with self.__measure(request.methodId, units):
+                    return request.execute()
+            except HttpError as err:
+                if quota.is_throttled(err.status_code, get_error_reason(err)):
+                    throttled(
+                        quota.parse_retry_after(err.resp.get("retry-after"))
+                    )
+                raise
+
+    def execute_batch(self, func, callback):
+        service = self.service
+        # pylint: disable=no-member
+        requests = list(func(service.users))
+        method_ids = {
+            request_id: request.methodId for request_id, request in requests
+        }
+        units = sum(map(quota.get_quota_units, method_ids.values()))
+        with self.scheduler.request(units) as throttled:
+
+            def batch_callback(request_id, response, exception):
+                # Quota units are counted under the sub-requests, latency
+                # and bytes under the batch request
+                self.metrics.add_call(
+                    method_ids[request_id],
+                    exception.status_code if exception is not None else 200,
+                    quota.get_quota_units(method_ids[request_id]),
+                )
+                if exception is not None and quota.is_throttled(
+                    exception.status_code, get_error_reason(exception)
+                ):
+                    throttled(
+                        quota.parse_retry_after(
+                            exception.resp.get("retry-after")
+                        )
+                    )
+                callback(request_id, response, exception)
+
+            batch = service.new_batch_http_request(callback=batch_callback)
+            for request_id, request in requests:
+                batch.add(request, request_id=request_id)
+            try:
+                with self.__measure("batch", 0):
+                    batch.execute()
+            except HttpError as err:
+                if quota.is_throttled(err.status_code, get_error_reason(err)):
+                    throttled(
+                        quota.parse_retry_after(err.resp.get("retry-after"))
+                    )
+                raise
+
+
 def __http_error(err):
     print(f"HTTP error returned by Gmail: {err.reason}")
 
@@ -79,19 +344,73 @@ def __connection_error(err):
     print(f"Connection error: {err}")
 
 
-def __execute(creds, func) -> Dict[str, Any]:
-    service = build("gmail", "v1", credentials=creds)
-    # The attribute 'user' is dynamically added to the object 'service'
-    # and thus not known to pylint
-    # pylint: disable=no-member
-    response = func(service.users).execute()
+def __execute(client, func) -> Dict[str, Any]:
+    # Text is not repaired here, but only for fields actually displayed
+    # or matched (see 'message.fix_text')
+    response = client.execute(func)
     if not response:
         return {}
-    for key, value in response.items():
-        response[key] = __fix_strings(value)
     return response
 
 
+def __execute_with_retries(client, func) -> Dict[str, Any]:
+    # Retries idempotent requests failed due to exceeded quota, backend
+    # or network errors with exponential backoff
+    for num_retries in range(MAX_RETRIES + 1):
+        if num_retries > 0:
+            time.sleep(backoff_time(num_retries))
+        try:
+            return __execute(client, func)
+        except HttpError as err:
+            if (
+                not is_retryable(err.status_code, get_error_reason(err))
+                or num_retries == MAX_RETRIES
+            ):
+                raise
+            client.metrics.add_retry(err.status_code)
+        except NETWORK_ERRORS:
+            if num_retries == MAX_RETRIES:
+                raise
+            client.metrics.add_retry(metrics.NETWORK_ERROR)
+    return {}
+
+
+def __execute_batch(client, func):
+    # The function returns (request_id, request) pairs, which are sent
+    # as a single HTTP batch request
+    responses = {}
+    errors = {}
+
+    def callback(request_id, response, exception):
+        if exception is not None:
+            errors[request_id] = exception
+        elif response:
+            responses[request_id] = response
+
+    client.execute_batch(func, callback)
+    return (responses, errors)
+
+
+def get_fields(method_id):
+    return FIELDS.get(method_id)
+
+
+def get_error_reason(err):
+    # Reason of an HTTP error, e.g., 'rateLimitExceeded' (if any)
+    return quota.parse_error_reason(err.content)
+
+
+def is_retryable(status_code, reason=None):
+    # HTTP status code 403 (rate limit reasons only) or 429: quota
+    # exceeded, 5xx: backend error
+    return quota.is_throttled(status_code, reason) or status_code >= 500
+
+
+def backoff_time(num_retries):
+    # Delay task after communication failure (exponential backoff)
+    return random.random() * 2**num_retries
+
+
 def __fix_strings(obj):
     if isinstance(obj, dict):
         for key, value in obj.items():
@@ -100,11 +419,12 @@ def __fix_strings(obj):
         for index, value in enumerate(obj):
             obj[index] = __fix_strings(value)
     elif isinstance(obj, str):
-        obj = ftfy.fix_text(html.unescape(obj))
+        obj = fix_text(obj)
     return obj
 
 
-def authenticate(token_file, credentials_file):
+def authenticate(token_file, credentials_file, interactive=True):
+    # Without interaction, profiles requiring a login at Gmail fail
     creds = None
     # The file token.json stores the user's access and refresh tokens,
     # and is created automatically when the authorization flow completes
@@ -120,6 +440,9 @@ def authenticate(token_file, credentials_file):
             except GoogleAuthError as err:
                 __auth_error(err)
                 return (None, True)
+        elif not interactive:
+            print(f"No valid token found, login required [{token_file}]")
+            return (None, True)
         else:
             print(
                 f"No valid token found: login at Gmail [create '{token_file}']"
@@ -136,192 +459,485 @@ def authenticate(token_file, credentials_file):
         os.makedirs(os.path.dirname(token_file), exist_ok=True)
         with open(token_file, "w", encoding="utf-8") as token:
             token.write(creds.to_json())
-    return (creds, False)
+    return (Client(creds, os.path.dirname(token_file)), False)
 
 
-def get_profile(creds):
+def get_profile(client):
     try:
-        response = __execute(
-            creds, lambda users: users().getProfile(userId="me")
+        response = __execute_with_retries(
+            client,
+            lambda users: users().getProfile(
+                userId="me", fields=get_fields("gmail.users.getProfile")
+            ),
         )
     except HttpError as err:
         __http_error(err)
         return ({}, True)
-    except ServerNotFoundError as err:
+    except NETWORK_ERRORS as err:
         __connection_error(err)
         return ({}, True)
     return (response, False)
 
 
-def get_message_ids(creds):
+def __list_message_ids(client, **params):
+    # Generator of message id pages (does not include TRASH and SPAM)
+    page_token = ""
+    while True:
+        response = __execute_with_retries(
+            client,
+            lambda users: users()
+            .messages()
+            .list(
+                userId="me",
+                maxResults=MAX_RESULTS,
+                pageToken=page_token,
+                fields=get_fields("gmail.users.messages.list"),
+                **params,
+            ),
+        )
+        messages = response.get("messages", [])
+        yield list(map(lambda msg: msg["id"], messages))
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            break
+
+
+def __estimate_message_count(client, query):
+    # Estimated number of messages matching a search query (a single
+    # request, the estimate may be inaccurate for large results)
+    response = __execute_with_retries(
+        client,
+        lambda users: users()
+        .messages()
+        .list(userId="me", maxResults=1, q=query, fields="resultSizeEstimate"),
+    )
+    return int(response.get("resultSizeEstimate", 0))
+
+
+def __get_shard_query(lower, upper):
+    # Search query of a date range, None bounds are open. Neighboring
+    # ranges overlap by a second (ids are deduplicated), so no message is
+    # missed.
+    terms = []
+    if lower is not None:
+        terms.append(f"after:{lower - 1}")
+    if upper is not None:
+        terms.append(f"before:{upper + 1}")
+    return " ".join(terms)
+
+
+def __get_shard_queries(client, num_messages):
+    # Search queries partitioning the mailbox into date ranges of about
+    # SHARD_SIZE messages. Starting from the whole mailbox, the ranges
+    # with the most messages are halved in rounds, sized by the estimated
+    # number of messages of their lower half (estimated concurrently),
+    # so that dense periods (e.g., recent years) get more shards than
+    # sparse ones. The first and last range are open.
+    num_shards = min(MAX_SHARDS, -(-num_messages // SHARD_SIZE))
+    if num_shards <= 1:
+        return [""]
+    now = int(time.time())
+    # Date ranges (lower, upper) with their estimated number of messages
+    shards = [((None, None), num_messages)]
+    while len(shards) < MAX_SHARDS:
+        splits = []
+        for index, ((lower, upper), size) in sorted(
+            enumerate(shards), key=lambda shard: -shard[1][1]
+        ):
+            start = SHARD_START_TIME if lower is None else lower
+            end = now if upper is None else upper
+            if len(shards) + len(splits) >= MAX_SHARDS:
+                break
+            if size > SHARD_SIZE and end - start > 1:
+                splits.append((index, (start + end) // 2))
+        if not splits:
+            break
+
+        def estimate(split):
+            (index, middle) = split
+            lower = shards[index][0][0]
+            return __estimate_message_count(
+                client, __get_shard_query(lower, middle)
+            )
+
+        estimates = client.listing_pool.map(estimate, splits)
+        for (index, middle), lower_size in zip(splits, estimates):
+            ((lower, upper), size) = shards[index]
+            lower_size = min(lower_size, size)
+            shards[index] = ((lower, middle), lower_size)
+            shards.append(((middle, upper), size - lower_size))
+    shards.sort(key=lambda shard: shard[0][0] or 0)
+    return [__get_shard_query(lower, upper) for (lower, upper), _ in shards]
+
+
+def __list_message_ids_sharded(client, num_messages, callback):
+    # Pages through all shards concurrently (a single query cannot be
+    # processed in parallel due to page-based processing), 'callback'
+    # is called with each page of ids not seen before
+    seen_ids = set()
+    lock = Lock()
+
+    def body(query):
+        for msg_ids in __list_message_ids(client, q=query):
+            with lock:
+                msg_ids = [i for i in msg_ids if i not in seen_ids]
+                seen_ids.update(msg_ids)
+                callback(msg_ids)
+
+    client.listing_pool.map(body, __get_shard_queries(client, num_messages))
+
+
+def get_label_message_ids(client, label_ids):
+    # Lists the message ids of each label (does not include TRASH and
+    # SPAM), labels are listed concurrently
+    def body(label_id):
+        msg_ids = set()
+        for page in __list_message_ids(client, labelIds=[label_id]):
+            msg_ids.update(page)
+        return (label_id, msg_ids)
+
+    print("Get message ids by label ...")
+    try:
+        label_message_ids = dict(client.listing_pool.map(body, label_ids))
+    except HttpError as err:
+        __http_error(err)
+        return ({}, True)
+    except NETWORK_ERRORS as err:
+        __connection_error(err)
+        return ({}, True)
+    return (label_message_ids, False)
+
+
+def get_message_ids(client):
     # Get number of total messages (does not include TRASH and SPAM)
-    (profile, err) = get_profile(creds)
+    (profile, err) = get_profile(client)
     if err:
         return ([], True)
     num_messages = profile["messagesTotal"]
     if not num_messages:
         return ([], False)
 
-    # Download messages ids (cannot be processed in parallel due to
-    # page-based processing)
+    # Download messages ids
     messages_ids = []
     print("Get message ids ...")
     with MyBar("Downloading", max=num_messages) as mybar:
-        page_token = ""
-        while True:
-            try:
-                response = __execute(
-                    creds,
-                    lambda users: users()
-                    .messages()
-                    .list(
-                        userId="me",
-                        maxResults=MAX_RESULTS,
-                        pageToken=page_token,
-                        # includeSpamTrash='true'
-                    ),
-                )
-            except HttpError as err:
-                __http_error(err)
-                return ([], True)
-            except ServerNotFoundError as err:
-                __connection_error(err)
-                return ([], True)
-            messages = response.get("messages", [])
-            messages = list(map(lambda msg: msg["id"], messages))
+
+        def callback(messages):
             messages_ids.extend(messages)
             mybar.next(len(messages))
-            page_token = response.get("nextPageToken")
-            if not page_token:
-                break
-    return (messages_ids, False)
-
 
-def get_messages(creds, message_ids):
-    if not message_ids:
-        return ([], False)
+        try:
+            __list_message_ids_sharded(client, num_messages, callback)
+        except HttpError as err:
+            __http_error(err)
+            return ([], True)
+        except NETWORK_ERRORS as err:
+            __connection_error(err)
+            return ([], True)
+    return (messages_ids, False)
 
-    # Download message data
-    messages = []
-    print("Get message data ...")
-    with MyBar("Downloading", max=len(message_ids)) as mybar:
-        lock = Lock()
 
-        def body(message_id):
-            error = None
-            for num_retries in range(MAX_RETRIES + 1):
-                if num_retries > 0:
-                    # Delay task after communication failure
-                    # (exponential backoff)
-                    sleep_time = random.random() * 2**num_retries
-                    time.sleep(sleep_time)
+def __download_messages(client, msg_ids, report):
+    # Downloads a chunk of messages with a single batch request, the
+    # function 'report' is called with the downloaded messages and the
+    # number of processed ids after each attempt
+    error = None
+    for num_retries in range(MAX_RETRIES + 1):
+        if num_retries > 0:
+            time.sleep(backoff_time(num_retries))
 
-                try:
-                    response = __execute(
-                        creds,
-                        lambda users: users()
+        try:
+            (responses, errors) = __execute_batch(
+                client,
+                lambda users: [
+                    (
+                        msg_id,
+                        users()
                         .messages()
                         .get(
                             userId="me",
-                            id=message_id,
+                            id=msg_id,
                             format="metadata",
                             metadataHeaders=["From", "Subject"],
+                            fields=get_fields("gmail.users.messages.get"),
                         ),
                     )
-                except HttpError as err:
-                    error = err
-                    # HTTP status code 403: quota of queries per minute
-                    # exceeded, retry
-                    if err.status_code == 403:
-                        continue
-                    # HTTP status code 404: element not found, continue
-                    # without element
-                    if err.status_code == 404:
-                        response = {}
-                    else:
-                        break
-                except (ServerNotFoundError, timeout) as err:
-                    error = err
-                    # Network or socket error, retry
-                    continue
+                    for msg_id in msg_ids
+                ],
+            )
+        except HttpError as err:
+            error = err
+            # Quota of queries exceeded or backend error, retry whole
+            # batch
+            if is_retryable(err.status_code, get_error_reason(err)):
+                client.metrics.add_retry(err.status_code)
+                continue
+            break
+        except NETWORK_ERRORS as err:
+            error = err
+            # Network or socket error, retry
+            client.metrics.add_retry(metrics.NETWORK_ERROR)
+            continue
 
-                error = None
-                with lock:
-                    if response:
-                        messages.append(response)
-                    mybar.next()
-                break
+        # Only retry failed sub-requests
+        error = None
+        msg_ids = []
+        for msg_id, err in errors.items():
+            if is_retryable(err.status_code, get_error_reason(err)):
+                error = err
+                msg_ids.append(msg_id)
+                client.metrics.add_retry(err.status_code)
+            # HTTP status code 404: element not found, continue without
+            # element
+            elif err.status_code != 404:
+                raise err
+        report(
+            list(map(Message.from_response, responses.values())),
+            len(responses) + len(errors) - len(msg_ids),
+        )
+        if not msg_ids:
+            break
 
-            if error:
-                raise error
+    if error:
+        raise error
 
-        with ThreadPool(16) as pool:
-            try:
-                pool.map(body, message_ids)
-            except HttpError as err:
-                __http_error(err)
-                return ([], True)
-            except (ServerNotFoundError, timeout) as err:
-                __connection_error(err)
-                return ([], True)
-    return (messages, False)
 
+def get_messages(client, message_ids, callback=None):
+    # The optional callback is called with each chunk of downloaded
+    # messages, e.g., to store them before the download is complete
+    if not message_ids:
+        return ([], False)
+
+    # Partition message ids into chunks of maximum batch-request size,
+    # each chunk is downloaded by a single HTTP request
+    message_ids = list(message_ids)
+    msg_id_chunks = [
+        message_ids[i : i + MAX_BATCH_REQUESTS]
+        for i in range(0, len(message_ids), MAX_BATCH_REQUESTS)
+    ]
+
+    # Download message data
+    messages = []
+    print("Get message data ...")
+    with MyBar("Downloading", max=len(message_ids)) as mybar:
+        lock = Lock()
+
+        def report(msgs, num_processed):
+            with lock:
+                messages.extend(msgs)
+                if callback:
+                    callback(msgs)
+                mybar.next(num_processed)
 
-def get_history_items(creds, start_history_id):
-    # Download history items (cannot be processed in parallel due to
-    # page-based processing)
-    history_items = []
-    page_token = ""
-    print(f"Get history items since history id {start_history_id} ...")
-    while True:
         try:
-            # Does include TRASH and SPAM
-            response = __execute(
-                creds,
-                lambda users: users()
-                .history()
-                .list(
-                    userId="me",
-                    maxResults=MAX_RESULTS,
-                    pageToken=page_token,
-                    startHistoryId=start_history_id,
-                ),
+            client.pool.map(
+                lambda msg_ids: __download_messages(client, msg_ids, report),
+                msg_id_chunks,
             )
         except HttpError as err:
             __http_error(err)
             return ([], True)
-        except ServerNotFoundError as err:
+        except NETWORK_ERRORS as err:
             __connection_error(err)
             return ([], True)
-        history = response.get("history", [])
-        history_items.extend(history)
+    return (messages, False)
+
+
+def get_all_messages(client, skip_ids=(), callback=None):
+    # Lists message ids and downloads message data at the same time:
+    # each page of ids is passed to the download threads while the next
+    # page is requested. Messages with ids in 'skip_ids' are not
+    # downloaded, 'callback' is called with each chunk of downloaded
+    # messages.
+    (profile, err) = get_profile(client)
+    if err:
+        return ([], True)
+    num_messages = profile["messagesTotal"]
+
+    messages = []
+    errors = []
+    # Bounded queue, so that listing cannot run arbitrarily far ahead of
+    # downloading
+    chunks = Queue(maxsize=MAX_QUEUED_CHUNKS)
+    failed = Event()
+    print("Get message ids and data ...")
+    with MyBar("Downloading", max=num_messages) as mybar:
+        lock = Lock()
+
+        def report(msgs, num_processed):
+            with lock:
+                messages.extend(msgs)
+                if callback:
+                    callback(msgs)
+                mybar.next(num_processed)
+
+        def enqueue(msg_ids):
+            # Do not enqueue further ids if the download threads failed
+            if failed.is_set():
+                return
+            new_ids = [i for i in msg_ids if i not in skip_ids]
+            report([], len(msg_ids) - len(new_ids))
+            for i in range(0, len(new_ids), MAX_BATCH_REQUESTS):
+                chunks.put(new_ids[i : i + MAX_BATCH_REQUESTS])
+
+        def produce():
+            try:
+                __list_message_ids_sharded(client, num_messages, enqueue)
+            # pylint: disable=broad-except
+            except Exception as err:
+                errors.append(err)
+            finally:
+                # Download threads keep draining the queue until they
+                # receive their end marker
+                for _ in range(NUM_THREADS):
+                    chunks.put(None)
+
+        def consume(_):
+            while True:
+                msg_ids = chunks.get()
+                if msg_ids is None:
+                    break
+                if failed.is_set():
+                    continue
+                try:
+                    __download_messages(client, msg_ids, report)
+                # pylint: disable=broad-except
+                except Exception as err:
+                    errors.append(err)
+                    failed.set()
+
+        producer = Thread(target=produce, daemon=True)
+        producer.start()
+        client.pool.map(consume, range(NUM_THREADS))
+        producer.join()
+
+    if errors:
+        # Only report the first error, the others are likely follow-ups
+        err = errors[0]
+        if isinstance(err, HttpError):
+            __http_error(err)
+        elif isinstance(err, NETWORK_ERRORS):
+            __connection_error(err)
+        else:
+            raise err
+        return ([], True)
+    return (messages, False)
+
+
+def __list_history_pages(client, start_history_id):
+    # Generator of history item pages (cannot be processed in parallel
+    # due to page-based processing)
+    page_token = ""
+    while True:
+        # Does include TRASH and SPAM
+        response = __execute_with_retries(
+            client,
+            lambda users: users()
+            .history()
+            .list(
+                userId="me",
+                maxResults=MAX_RESULTS,
+                pageToken=page_token,
+                startHistoryId=start_history_id,
+                historyTypes=HISTORY_TYPES,
+                fields=get_fields("gmail.users.history.list"),
+            ),
+        )
+        yield response.get("history", [])
         page_token = response.get("nextPageToken")
         if not page_token:
             break
-    return (history_items, False)
 
 
-def get_labels(creds):
+def process_history_pages(client, start_history_id, callback):
+    """Calls 'callback' with each page of history items
+
+    The next pages are fetched while the callback processes the current
+    one. The callback returns False to stop processing. Returns whether
+    the start history id has expired, i.e., is older than the history
+    kept by Gmail, and whether an error occurred.
+    """
+    pages = Queue(maxsize=MAX_QUEUED_PAGES)
+    stopped = Event()
+    errors = []
+
+    def produce():
+        try:
+            for history_items in __list_history_pages(client, start_history_id):
+                if stopped.is_set():
+                    break
+                pages.put(history_items)
+        # pylint: disable=broad-except
+        except Exception as err:
+            errors.append(err)
+        finally:
+            pages.put(None)
+
+    print(f"Get history items since history id {start_history_id} ...")
+    producer = Thread(target=produce, daemon=True)
+    producer.start()
+    success = True
+    try:
+        while True:
+            history_items = pages.get()
+            if history_items is None:
+                break
+            # Keep draining the queue after stopping, so that the producer
+            # is not blocked
+            if success and not callback(history_items):
+                success = False
+                stopped.set()
+    finally:
+        # Also stop the producer if the callback raised: after draining
+        # the queue, it can put its current page and end marker without
+        # blocking
+        stopped.set()
+        while not pages.empty():
+            pages.get_nowait()
+    producer.join()
+
+    if errors:
+        err = errors[0]
+        if isinstance(err, HttpError):
+            # HTTP status code 404: history id no longer available
+            if err.status_code == 404:
+                print(f"History id {start_history_id} has expired")
+                return (True, False)
+            __http_error(err)
+        elif isinstance(err, NETWORK_ERRORS):
+            __connection_error(err)
+        else:
+            raise err
+        return (False, True)
+    return (False, not success)
+
+
+def get_labels(client):
     print("Get labels ...")
     try:
-        response = __execute(
-            creds, lambda users: users().labels().list(userId="me")
+        response = __execute_with_retries(
+            client,
+            lambda users: users()
+            .labels()
+            .list(userId="me", fields=get_fields("gmail.users.labels.list")),
         )
     except HttpError as err:
         __http_error(err)
         return ([], True)
-    except ServerNotFoundError as err:
+    except NETWORK_ERRORS as err:
         __connection_error(err)
         return ([], True)
     labels = response.get("labels", [])
+    for label in labels:
+        label["name"] = fix_text(label["name"])
     return (labels, False)
 
 
-def create_label(creds, label_name):
+def create_label(client, label_name):
     print(f"Create label '{label_name}' ...")
     try:
         response = __execute(
-            creds,
+            client,
             lambda users: users()
             .labels()
             .create(userId="me", body={"name": label_name}),
@@ -329,56 +945,71 @@ def create_label(creds, label_name):
     except HttpError as err:
         __http_error(err)
         return ({}, True)
-    except ServerNotFoundError as err:
+    except NETWORK_ERRORS as err:
         __connection_error(err)
         return ({}, True)
     return (response, False)
 
 
-def modify_message_labels(creds, message_ids, add_label_ids, remove_label_ids):
-    if not message_ids:
-        return True
+def __modify_messages(client, msg_ids, add_label_ids, remove_label_ids):
+    # Modifies the labels of a chunk of messages with a single request
+    # (setting labels is idempotent, so failed requests are retried).
+    # Response is ignored, since it only returns an empty body on
+    # success.
+    __execute_with_retries(
+        client,
+        lambda users: users()
+        .messages()
+        .batchModify(
+            userId="me",
+            body={
+                "ids": msg_ids,
+                "addLabelIds": add_label_ids,
+                "removeLabelIds": remove_label_ids,
+            },
+        ),
+    )
 
-    # Partition message ids into chunks of maximum batch-processible
-    # size
-    msg_id_chunks = [
-        message_ids[i : i + MAX_BATCH_SIZE]
+
+def batch_modify_message_labels(client, operations):
+    """Applies label operations to messages concurrently
+
+    Operations are (message ids, label ids to add, label ids to remove)
+    tuples. Their message ids are partitioned into chunks of maximum
+    batch-processible size, which are sent by multiple threads under the
+    quota scheduler.
+    """
+    chunks = [
+        (list(message_ids[i : i + MAX_BATCH_SIZE]), add_ids, remove_ids)
+        for (message_ids, add_ids, remove_ids) in operations
         for i in range(0, len(message_ids), MAX_BATCH_SIZE)
     ]
+    if not chunks:
+        return True
 
     # Modify message labels
-    print(f"Modify labels of {len(message_ids)} messages ...")
-    for msg_ids in msg_id_chunks:
+    num_messages = sum(len(chunk[0]) for chunk in chunks)
+    print(f"Modify labels of {num_messages} messages ...")
+    with MyBar("Modifying", max=num_messages) as mybar:
+        lock = Lock()
+
+        def body(chunk):
+            __modify_messages(client, *chunk)
+            with lock:
+                mybar.next(len(chunk[0]))
+
         try:
-            # Response is ignored, since it only returns an empty body
-            # on success
-            _ = __execute(
-                creds,
-                lambda users: users()
-                .messages()
-                .batchModify(
-                    userId="me",
-                    body={
-                        # The lambda function is called at the time of
-                        # the function call '__execute', so no issues
-                        # with the loop variable used in the lambda
-                        # pylint: disable=cell-var-from-loop
-                        "ids": msg_ids,
-                        "addLabelIds": add_label_ids,
-                        "removeLabelIds": remove_label_ids,
-                    },
-                ),
-            )
+            client.pool.map(body, chunks)
         except HttpError as err:
             __http_error(err)
             return False
-        except ServerNotFoundError as err:
+        except NETWORK_ERRORS as err:
             __connection_error(err)
             return False
     return True
 
 
-def execute_api_call(creds, calls, args):
+def execute_api_call(client, calls, args):
     def body(resource):
         for call in calls:
             if not hasattr(resource(), call):
@@ -387,11 +1018,11 @@ def execute_api_call(creds, calls, args):
         return resource(userId="me", **args)
 
     try:
-        response = __execute(creds, body)
+        response = __execute(client, body)
     except HttpError as err:
         __http_error(err)
         return ({}, True)
-    except ServerNotFoundError as err:
+    except NETWORK_ERRORS as err:
         __connection_error(err)
         return ({}, True)
     except ValueError as err:
@@ -400,4 +1031,5 @@ def execute_api_call(creds, calls, args):
     except TypeError as err:
         print(err)
         return ({}, True)
-    return (response, False)
+    # Response is displayed as a whole
+    return (__fix_strings(response), False)
@@ -0,0 +1,314 @@
+"""asyncio engine for downloading message data
+
+Alternative to the thread pool in 'gmail_api': many requests are kept
+in flight on a single thread and multiplexed over a few HTTP/2
+connections. Without HTTP/2 (e.g., against the local stand-in), each
+connection only has a single request in flight. Retries follow the same
+rules as the threaded engine.
+"""
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from itertools import islice
+from urllib.parse import urljoin
+from weakref import WeakKeyDictionary
+
+import httpx
+
+from . import gmail_api, metrics, quota, transport
+from .message import Message
+
+# Maximum number of HTTP connections (as many as threads of the threaded
+# engine)
+MAX_CONNECTIONS = gmail_api.NUM_THREADS
+
+# Maximum number of requests in flight per HTTP/2 connection
+MAX_STREAMS = 16
+
+# Timeout of a single request in seconds
+TIMEOUT = 60
+
+# Engines of the clients (dropped with their clients)
+__engines = WeakKeyDictionary()
+
+
+class ApiError(Exception):
+    def __init__(self, status_code, reason):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+
+    @classmethod
+    def from_response(cls, response):
+        try:
+            reason = response.json()["error"]["message"]
+        except (ValueError, KeyError, TypeError):
+            reason = response.reason_phrase
+        return cls(response.status_code, reason)
+
+
+def __http_error(err):
+    print(f"HTTP error returned by Gmail: {err.reason}")
+
+
+def __connection_error(err):
+    print(f"Connection error: {err}")
+
+
+class Engine:
+    """Sends requests of a client concurrently on an event loop
+
+    Requests are only sent if a connection (or HTTP/2 stream) is free,
+    so that they do not hold quota slots while waiting for connections.
+    The protocol is known once the first response has been received,
+    until then only a single request per connection is in flight.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.max_in_flight = MAX_CONNECTIONS
+        self.scheduler = self.__create_scheduler()
+        doc = client.discovery_doc
+        self.base_url = urljoin(
+            urljoin(doc["rootUrl"], doc["servicePath"]), "gmail/v1/users/me/"
+        )
+
+    def __create_scheduler(self):
+        # Concurrency is only limited by the number of requests in flight,
+        # quota units are taken from the bucket of the client, so that
+        # both engines together keep to the per-user quota
+        return quota.Scheduler(
+            max_concurrency=self.max_in_flight,
+            bucket=self.client.scheduler.bucket,
+        )
+
+    def __negotiated(self, http_version):
+        # HTTP/2 multiplexes requests over each connection
+        if http_version == "HTTP/2" and self.max_in_flight == MAX_CONNECTIONS:
+            self.max_in_flight = MAX_CONNECTIONS * MAX_STREAMS
+            self.scheduler = self.__create_scheduler()
+
+    def session(self):
+        return httpx.AsyncClient(
+            base_url=self.base_url,
+            http2=True,
+            headers={
+                "Accept-Encoding": "gzip",
+                "User-Agent": transport.USER_AGENT,
+            },
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_CONNECTIONS,
+            ),
+            # Requests wait for a free connection without timing out
+            timeout=httpx.Timeout(TIMEOUT, pool=None),
+        )
+
+    async def __get_token(self, failed_token=None):
+        # Credentials are refreshed by the client (outside of the event
+        # loop), shared with the threaded engine
+        creds = self.client.creds
+        if creds.valid and failed_token != creds.token:
+            return creds.token
+        return await asyncio.to_thread(self.client.get_token, failed_token)
+
+    @staticmethod
+    async def __acquire(scheduler, units):
+        while True:
+            delay = scheduler.try_acquire(units)
+            if not delay:
+                return
+            await asyncio.sleep(delay)
+
+    @asynccontextmanager
+    async def __request(self, units):
+        # Equivalent of 'Scheduler.request', the slot is also released if
+        # the request is cancelled (e.g., after another worker failed)
+        throttle = {}
+
+        def throttled(retry_after=0):
+            throttle["retry_after"] = retry_after
+
+        # The scheduler is replaced once HTTP/2 has been negotiated
+        scheduler = self.scheduler
+        await self.__acquire(scheduler, units)
+        try:
+            yield throttled
+        finally:
+            scheduler.release(
+                "retry_after" in throttle, throttle.get("retry_after", 0)
+            )
+
+    async def get(self, http, method_id, path, params):
+        """Sends a GET request with the retry rules of the threaded engine
+
+        Returns an empty dict if the element was not found (404).
+        """
+        error = None
+        failed_token = None
+        for num_retries in range(gmail_api.MAX_RETRIES + 1):
+            if num_retries > 0:
+                await asyncio.sleep(gmail_api.backoff_time(num_retries))
+
+            token = await self.__get_token(failed_token)
+            units = quota.get_quota_units(method_id)
+            async with self.__request(units) as throttled:
+                start = time.perf_counter()
+                try:
+                    response = await http.get(
+                        path,
+                        params=params,
+                        headers={"Authorization": f"Bearer {token}"},
+                    )
+                except httpx.TransportError as err:
+                    self.client.metrics.add_call(
+                        method_id,
+                        metrics.NETWORK_ERROR,
+                        units,
+                        time.perf_counter() - start,
+                    )
+                    self.client.metrics.add_retry(metrics.NETWORK_ERROR)
+                    error = err
+                    # Network or socket error, retry
+                    continue
+
+                self.__negotiated(response.http_version)
+                status_code = response.status_code
+                self.client.metrics.add_call(
+                    method_id,
+                    status_code,
+                    units,
+                    time.perf_counter() - start,
+                    len(response.content),
+                )
+                reason = (
+                    quota.parse_error_reason(response.content)
+                    if status_code >= 400
+                    else None
+                )
+                if quota.is_throttled(status_code, reason):
+                    throttled(
+                        quota.parse_retry_after(
+                            response.headers.get("retry-after")
+                        )
+                    )
+            if status_code < 400:
+                return response.json()
+
+            error = ApiError.from_response(response)
+            # HTTP status code 401: access token expired, refresh once
+            if status_code == 401 and not failed_token:
+                failed_token = token
+                self.client.metrics.add_retry(status_code)
+                continue
+            if gmail_api.is_retryable(status_code, reason):
+                self.client.metrics.add_retry(status_code)
+                continue
+            # HTTP status code 404: element not found, continue without
+            # element
+            if status_code == 404:
+                return {}
+            raise error
+        raise error
+
+    async def get_messages(self, message_ids, mybar, callback=None):
+        messages = []
+        # Messages not yet passed to the callback
+        unreported = []
+        message_ids = iter(message_ids)
+        params = [
+            ("format", "metadata"),
+            ("metadataHeaders", "From"),
+            ("metadataHeaders", "Subject"),
+        ]
+        fields = gmail_api.get_fields("gmail.users.messages.get")
+        if fields:
+            params.append(("fields", fields))
+
+        async def worker(http, limit=None):
+            # All workers share the same id iterator
+            for message_id in islice(message_ids, limit):
+                response = await self.get(
+                    http,
+                    "gmail.users.messages.get",
+                    f"messages/{message_id}",
+                    params,
+                )
+                if response:
+                    message = Message.from_response(response)
+                    messages.append(message)
+                    unreported.append(message)
+                if callback and len(unreported) >= gmail_api.MAX_BATCH_REQUESTS:
+                    callback(unreported[:])
+                    unreported.clear()
+                mybar.next()
+
+        try:
+            async with self.session() as http:
+                # The first response tells the number of requests in
+                # flight (the protocol), one worker per request
+                await worker(http, 1)
+                workers = [
+                    asyncio.create_task(worker(http))
+                    for _ in range(self.max_in_flight)
+                ]
+                try:
+                    await asyncio.gather(*workers)
+                finally:
+                    # Stop the other workers if one has failed, before
+                    # the session is closed
+                    for task in workers:
+                        task.cancel()
+                    await asyncio.gather(*workers, return_exceptions=True)
+        finally:
+            if callback and unreported:
+                callback(unreported)
+        return messages
+
+
+def __get_engine(client):
+    # A single engine per client, so that its concurrency adapted to
+    # throttling is kept across calls
+    engine = __engines.get(client)
+    if engine is None:
+        engine = Engine(client)
+        __engines[client] = engine
+    return engine
+
+
+def get_messages(client, message_ids, callback=None):
+    # The optional callback is called with chunks of downloaded messages
+    if not message_ids:
+        return ([], False)
+
+    # Download message data
+    print("Get message data ...")
+    with gmail_api.MyBar("Downloading", max=len(message_ids)) as mybar:
+        try:
+            messages = asyncio.run(
+                __get_engine(client).get_messages(message_ids, mybar, callback)
+            )
+        except ApiError as err:
+            __http_error(err)
+            return ([], True)
+        except httpx.TransportError as err:
+            __connection_error(err)
+            return ([], True)
+    return (messages, False)
+
+
+def get_all_messages(client, skip_ids=(), callback=None):
+    # Message ids are listed by the threaded engine first (page-based
+    # processing), afterwards message data is downloaded asynchronously
+    (message_ids, err) = gmail_api.get_message_ids(client)
+    if err:
+        return ([], True)
+    message_ids = [i for i in message_ids if i not in skip_ids]
+    return get_messages(client, message_ids, callback)
+
+
+def process_history_pages(client, start_history_id, callback):
+    # History pages are listed by the threaded engine (only few requests
+    # due to page-based processing), while messages of the pages are
+    # downloaded asynchronously
+    return gmail_api.process_history_pages(client, start_history_id, callback)
@@ -0,0 +1,54 @@
+"""Index for label hierarchy and name lookups
+
+Label names are hierarchical (components separated by slashes) and are
+compared case-insensitively.
+"""
+
+
+def tokenize(label_name):
+    return tuple(filter(None, label_name.lower().split("/")))
+
+
+class LabelIndex:
+    """Precomputed lookups over a dict of labels (keyed by label ids)"""
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.tokens = {}
+        # Flattened prefix trie: ids of all labels at or below each
+        # prefix of label components
+        sublabel_ids = {}
+        # Labels by their last label component
+        self.__by_last_component = {}
+        for label_id, label in labels.items():
+            tokens = tokenize(label["name"])
+            self.tokens[label_id] = tokens
+            for depth in range(len(tokens) + 1):
+                sublabel_ids.setdefault(tokens[:depth], set()).add(label_id)
+            last_component = tokens[-1] if tokens else ""
+            self.__by_last_component.setdefault(last_component, []).append(
+                label
+            )
+        self.__sublabel_ids = {
+            prefix: frozenset(ids) for prefix, ids in sublabel_ids.items()
+        }
+        self.__ids_by_name = {
+            tokens: label_id for label_id, tokens in self.tokens.items()
+        }
+
+    def exists(self, label_name):
+        return tokenize(label_name) in self.__ids_by_name
+
+    def get_label_id(self, label_name):
+        return self.__ids_by_name.get(tokenize(label_name))
+
+    def get_sublabel_ids(self, label_name):
+        """Returns the ids of the label and all of its sublabels"""
+        return self.__sublabel_ids.get(tokenize(label_name), frozenset())
+
+    def get_labels_by_last_component(self, component):
+        return self.__by_last_component.get(component.lower(), [])
+
+    @property
+    def last_components(self):
+        return self.__by_last_component.keys()
@@ -0,0 +1,104 @@
+"""Compact representation of message data"""
+import html
+import sys
+
+import ftfy
+
+from . import domains
+
+
+def fix_text(text):
+    """Unescapes HTML entities and repairs broken unicode
+
+    Pure ASCII text without entities cannot contain anything to repair
+    and is returned as is.
+    """
+    if text.isascii() and "&" not in text:
+        return text
+    return ftfy.fix_text(html.unescape(text))
+
+
+class Message:
+    """Message data needed for analysis and sorting
+
+    Only the id, label ids, sender (From header), subject and snippet are
+    kept from the API response. Label ids are interned, since there are
+    only few distinct ones shared by all messages. Text fields are kept as
+    received and only repaired when they are read. Sender address and
+    domains are extracted once on creation, unless given (e.g., when
+    loaded from the store).
+    """
+
+    __slots__ = (
+        "id",
+        "label_ids",
+        "raw_sender",
+        "raw_subject",
+        "raw_snippet",
+        "sender_address",
+        "fq_domain",
+        "domain",
+    )
+
+    # pylint: disable=too-many-arguments,redefined-builtin
+    def __init__(
+        self,
+        id,
+        label_ids=(),
+        sender="",
+        subject="",
+        snippet="",
+        sender_domains=None,
+    ):
+        self.id = id
+        self.label_ids = tuple(map(sys.intern, label_ids))
+        self.raw_sender = sender
+        self.raw_subject = subject
+        self.raw_snippet = snippet
+        if sender_domains is None:
+            sender_domains = domains.get_sender_domains(self.sender)
+        (self.sender_address, self.fq_domain, self.domain) = sender_domains
+
+    @property
+    def sender(self):
+        return fix_text(self.raw_sender)
+
+    @property
+    def subject(self):
+        return fix_text(self.raw_subject)
+
+    @property
+    def snippet(self):
+        return fix_text(self.raw_snippet)
+
+    def modify_labels(self, add_label_ids=(), remove_label_ids=()):
+        label_ids = [i for i in self.label_ids if i not in remove_label_ids]
+        label_ids.extend(i for i in add_label_ids if i not in label_ids)
+        self.label_ids = tuple(map(sys.intern, label_ids))
+
+    @classmethod
+    def from_response(cls, response):
+        """Creates a message from a 'messages.get' response"""
+        headers = {}
+        for header in response.get("payload", {}).get("headers", []):
+            # Only keep first occurrence of each header
+            headers.setdefault(header["name"].lower(), header["value"])
+        return cls(
+            response["id"],
+            response.get("labelIds", []),
+            headers.get("from", ""),
+            headers.get("subject", ""),
+            response.get("snippet", ""),
+        )
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "label_ids": self.label_ids,
+            "sender": self.sender,
+            "subject": self.subject,
+            "snippet": self.snippet,
+        }
+
+    def __repr__(self):
+        return f"Message({self.id!r})"
@@ -0,0 +1,163 @@
+"""Metrics of Gmail API calls and run reports
+
+API calls are recorded by the client (method, latency, status, quota
+units and bytes received) and retries by the functions retrying them.
+A run report adds phase timings and is written as json.
+"""
+import json
+import time
+from threading import Lock
+
+# Upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Status of requests failed due to network or socket errors
+NETWORK_ERROR = "network"
+
+
+class Histogram:
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        # Last bucket counts values above all bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        index = len(self.bounds)
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                index = i
+                break
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def to_dict(self):
+        labels = [str(bound) for bound in self.bounds] + ["inf"]
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 3),
+            "max": round(self.max, 3),
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+
+class ApiMetrics:
+    """Calls, latencies, statuses, quota units and bytes per API method
+
+    Sub-requests of batch requests are counted under their methods, but
+    their latency and bytes only under the batch request itself.
+    """
+
+    def __init__(self):
+        self.__methods = {}
+        self.__retries = {}
+        self.__lock = Lock()
+
+    def add_call(self, method_id, status, units=0, seconds=None, num_bytes=0):
+        with self.__lock:
+            method = self.__methods.get(method_id)
+            if method is None:
+                method = {
+                    "calls": 0,
+                    "statuses": {},
+                    "quota_units": 0,
+                    "bytes_received": 0,
+                    "latency": Histogram(),
+                }
+                self.__methods[method_id] = method
+            method["calls"] += 1
+            status = str(status)
+            method["statuses"][status] = method["statuses"].get(status, 0) + 1
+            method["quota_units"] += units
+            method["bytes_received"] += num_bytes
+            if seconds is not None:
+                method["latency"].add(seconds)
+
+    def add_retry(self, status):
+        with self.__lock:
+            status = str(status)
+            self.__retries[status] = self.__retries.get(status, 0) + 1
+
+    def to_dict(self):
+        with self.__lock:
+            methods = {
+                method_id: dict(method, latency=method["latency"].to_dict())
+                for method_id, method in sorted(self.__methods.items())
+            }
+            retries = dict(sorted(self.__retries.items()))
+        return {
+            "calls": sum(method["calls"] for method in methods.values()),
+            "quota_units": sum(
+                method["quota_units"] for method in methods.values()
+            ),
+            "bytes_received": sum(
+                method["bytes_received"] for method in methods.values()
+            ),
+            "retries": retries,
+            "methods": methods,
+        }
+
+
+class Report:
+    """Machine-readable report of a single run
+
+    The run is divided into consecutive phases, each phase lasts until
+    the next one is started or the report is closed. Used as context
+    manager, the report is written to the given file (if any) when
+    leaving it, also if the run failed.
+    """
+
+    def __init__(self, path, command, profile_name):
+        self.path = path
+        self.command = command
+        self.profile_name = profile_name
+        # Set after authentication to include its API metrics
+        self.client = None
+        # Reports of profiles synchronized in worker processes
+        self.profiles = []
+        self.phases = {}
+        self.__start = time.perf_counter()
+        self.__phase = None
+        self.__phase_start = self.__start
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.start_phase(None)
+        if self.path:
+            self.write(self.path, exc_type is None)
+
+    def start_phase(self, name):
+        """Ends the current phase and starts the given one (if any)"""
+        now = time.perf_counter()
+        if self.__phase:
+            self.phases[self.__phase] = round(
+                self.phases.get(self.__phase, 0) + now - self.__phase_start, 3
+            )
+        self.__phase = name
+        self.__phase_start = now
+
+    def to_dict(self, success=True):
+        report = {
+            "command": self.command,
+            "profile": self.profile_name,
+            "success": success,
+            "seconds": round(time.perf_counter() - self.__start, 3),
+            "phases": self.phases,
+        }
+        if self.client:
+            report["api"] = self.client.metrics.to_dict()
+            report["connections"] = self.client.connection_stats.to_dict()
+        if self.profiles:
+            report["profiles"] = self.profiles
+        return report
+
+    def write(self, path, success=True):
+        with open(path, "w", encoding="utf-8") as report_file:
+            json.dump(self.to_dict(success), report_file, indent=2)
+            report_file.write("\n")
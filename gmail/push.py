@@ -0,0 +1,66 @@
+"""Local listener for Gmail push notifications
+
+Gmail publishes mailbox changes to a Cloud Pub/Sub topic (see
+'users.watch'), whose push subscription (or a local stand-in of it)
+posts them to this listener. Notifications only wake up the watch loop,
+changes are still fetched from the history.
+"""
+import base64
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Thread
+
+
+class PushHandler(BaseHTTPRequestHandler):
+    def do_POST(self):  # pylint: disable=invalid-name
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            # Pub/Sub push message with base64 encoded json data, e.g.,
+            # {"emailAddress": "user@example.com", "historyId": "1234"}
+            envelope = json.loads(self.rfile.read(length))
+            data = json.loads(base64.b64decode(envelope["message"]["data"]))
+            history_id = int(data["historyId"])
+        except (ValueError, KeyError, TypeError):
+            self.send_response(400)
+            self.end_headers()
+            return
+        self.server.notify(history_id)
+        # Any 2xx status acknowledges the message
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class PushListener(ThreadingHTTPServer):
+    """Receives push notifications in a background thread
+
+    'wait' returns as soon as a notification arrived or the timeout has
+    passed.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port, host="127.0.0.1"):
+        super().__init__((host, port), PushHandler)
+        self.history_id = 0
+        self.__event = Event()
+        self.__thread = Thread(target=self.serve_forever, daemon=True)
+
+    def notify(self, history_id):
+        self.history_id = max(self.history_id, history_id)
+        self.__event.set()
+
+    def wait(self, timeout):
+        notified = self.__event.wait(timeout)
+        self.__event.clear()
+        return notified
+
+    def __enter__(self):
+        self.__thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,236 @@
+"""Quota-aware scheduling of Gmail API requests"""
+import json
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from threading import Condition, Lock
+
+# ------------------------------------------------------------------------------
+# Gmail API usage limits:
+# https://developers.google.com/gmail/api/reference/quota
+# ------------------------------------------------------------------------------
+
+# Quota units consumed per API method
+QUOTA_UNITS = {
+    "gmail.users.getProfile": 1,
+    "gmail.users.history.list": 2,
+    "gmail.users.labels.create": 5,
+    "gmail.users.labels.get": 1,
+    "gmail.users.labels.list": 1,
+    "gmail.users.messages.batchModify": 50,
+    "gmail.users.messages.get": 5,
+    "gmail.users.messages.list": 5,
+}
+
+# Error reasons of 403 responses due to exceeded quota
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+
+# Quota units of methods not listed above
+DEFAULT_QUOTA_UNITS = 5
+
+# Per-user quota units per second
+USER_QUOTA_RATE = 250
+
+# Maximum number of concurrent requests
+MAX_CONCURRENCY = 16
+
+# Minimum time in seconds between two decreases of rate and concurrency,
+# so that a burst of throttled requests only counts once
+DECREASE_INTERVAL = 1.0
+
+# Time to wait for running requests to finish when polling
+POLL_INTERVAL = 0.01
+
+# Number of successful requests after which concurrency is increased
+# again (additive increase, multiplicative decrease)
+INCREASE_INTERVAL = 10
+
+
+def get_quota_units(method_id):
+    return QUOTA_UNITS.get(method_id, DEFAULT_QUOTA_UNITS)
+
+
+def is_throttled(status_code, reason=None):
+    # HTTP status code 429 or 403 with a rate limit reason: quota of
+    # queries exceeded (other 403 errors are missing permissions)
+    return status_code == 429 or (
+        status_code == 403 and reason in RATE_LIMIT_REASONS
+    )
+
+
+def parse_error_reason(content):
+    """Returns the reason of the first error of an error response body
+
+    E.g., 'rateLimitExceeded', or None if the body has no reason.
+    """
+    try:
+        return json.loads(content)["error"]["errors"][0]["reason"]
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
+
+def parse_retry_after(value):
+    """Returns the delay of a Retry-After header value in seconds"""
+    if not value:
+        return 0
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 0
+
+
+class TokenBucket:
+    """Token bucket metering requests against the per-user quota
+
+    Each request takes its quota units from the bucket, which refills at
+    the current rate. Throttling responses (403/429) halve the rate and
+    block all requests until Retry-After has passed, while successful
+    requests slowly restore it.
+    """
+
+    def __init__(self, rate=USER_QUOTA_RATE):
+        self.max_rate = rate
+        self.rate = rate
+        self.__tokens = float(rate)
+        self.__updated = time.monotonic()
+        self.__blocked_until = 0.0
+        self.__decreased = 0.0
+        self.__lock = Lock()
+
+    def __refill(self, now):
+        self.__tokens = min(
+            float(self.max_rate),
+            self.__tokens + (now - self.__updated) * self.rate,
+        )
+        self.__updated = now
+
+    def try_take(self, units):
+        """Takes quota units without blocking
+
+        Returns 0 if the units were taken or otherwise the time to wait
+        before trying again.
+        """
+        with self.__lock:
+            now = time.monotonic()
+            self.__refill(now)
+            # Requests larger than the bucket only need a full bucket
+            needed = min(units, self.max_rate)
+            if now < self.__blocked_until:
+                return self.__blocked_until - now
+            if self.__tokens >= needed:
+                self.__tokens -= units
+                return 0
+            return (needed - self.__tokens) / self.rate
+
+    def decrease(self, retry_after=0):
+        with self.__lock:
+            now = time.monotonic()
+            if now - self.__decreased >= DECREASE_INTERVAL:
+                self.__decreased = now
+                self.rate = max(1, self.rate / 2)
+            if retry_after:
+                self.__blocked_until = max(
+                    self.__blocked_until, now + retry_after
+                )
+
+    def increase(self):
+        with self.__lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+class Scheduler:
+    """Limits the concurrency of requests metered by a token bucket
+
+    Throttling responses (403/429) halve the concurrency, while successful
+    requests slowly restore it. Schedulers with different concurrency
+    limits (e.g., of different engines) may share the bucket of the same
+    user.
+    """
+
+    def __init__(
+        self, rate=USER_QUOTA_RATE, max_concurrency=MAX_CONCURRENCY, bucket=None
+    ):
+        self.bucket = bucket or TokenBucket(rate)
+        self.max_concurrency = max_concurrency
+        self.concurrency = max_concurrency
+        self.__active = 0
+        self.__successes = 0
+        self.__decreased = 0.0
+        self.__cond = Condition()
+
+    @property
+    def max_rate(self):
+        return self.bucket.max_rate
+
+    @property
+    def rate(self):
+        return self.bucket.rate
+
+    def try_acquire(self, units):
+        """Takes quota units without blocking
+
+        Returns 0 if the request may be sent or otherwise the time to wait
+        before trying again.
+        """
+        with self.__cond:
+            if self.__active >= self.concurrency:
+                return POLL_INTERVAL
+            delay = self.bucket.try_take(units)
+            if not delay:
+                self.__active += 1
+            return delay
+
+    def acquire(self, units):
+        with self.__cond:
+            while True:
+                timeout = self.try_acquire(units)
+                if not timeout:
+                    return
+                if self.__active >= self.concurrency:
+                    # Wait for a running request to be released
+                    timeout = None
+                self.__cond.wait(timeout)
+
+    def release(self, throttled=False, retry_after=0):
+        with self.__cond:
+            self.__active -= 1
+            if throttled:
+                now = time.monotonic()
+                self.__successes = 0
+                if now - self.__decreased >= DECREASE_INTERVAL:
+                    self.__decreased = now
+                    self.concurrency = max(1, self.concurrency // 2)
+                self.bucket.decrease(retry_after)
+            else:
+                self.__successes += 1
+                if self.__successes >= INCREASE_INTERVAL:
+                    self.__successes = 0
+                    self.concurrency = min(
+                        self.max_concurrency, self.concurrency + 1
+                    )
+                    self.bucket.increase()
+            self.__cond.notify_all()
+
+    @contextmanager
+    def request(self, units):
+        """Context manager for a single request consuming quota units
+
+        The body may call the yielded function with the Retry-After delay
+        to report that the request was throttled.
+        """
+        throttle = {}
+
+        def throttled(retry_after=0):
+            throttle["retry_after"] = retry_after
+
+        self.acquire(units)
+        try:
+            yield throttled
+        finally:
+            self.release(
+                "retry_after" in throttle, throttle.get("retry_after", 0)
+            )
@@ -0,0 +1,154 @@
+"""Rules mapping sender domains and addresses to labels
+
+A rules file has one rule per line, a pattern followed by a label name
+(empty lines and lines starting with '#' are ignored):
+
+    example.com            Shopping/Example
+    *.example.org          Newsletters
+    news@example.net       Newsletters/Example
+
+Domain patterns match fully qualified domains exactly, wildcard patterns
+match all of their subdomains (but not the domain itself), and address
+patterns match sender addresses exactly. The most specific rule wins: an
+address before a domain before the deepest wildcard.
+
+Rules are compiled into a trie of reversed domain components and a dict
+of addresses, so that each sender resolves in time linear to the length
+of its domain. The compiled table is cached on disk, keyed by the hash of
+the rules file.
+"""
+import hashlib
+import json
+import os
+from json.decoder import JSONDecodeError
+
+from . import file_utils
+
+# File name of the compiled rules cache (stored in profile dir)
+CACHE_FILE = "rules.json"
+
+# Keys of trie nodes holding the label names of exact domain and wildcard
+# rules (cannot collide with domain components)
+EXACT_KEY = "="
+WILDCARD_KEY = "*"
+
+
+def parse_rules(text):
+    """Returns (pattern, label name) pairs of the rules text
+
+    Raises ValueError with the line number of malformed rules.
+    """
+    rules = []
+    for line_number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        tokens = line.split(maxsplit=1)
+        if len(tokens) != 2:
+            raise ValueError(f"line {line_number}: label name missing")
+        (pattern, label_name) = (tokens[0].lower(), tokens[1].strip())
+        if "@" in pattern:
+            (local_part, _, domain) = pattern.rpartition("@")
+            # Wildcards are only supported in domain patterns
+            if not local_part or "@" in local_part or "*" in local_part:
+                raise ValueError(
+                    f"line {line_number}: invalid address pattern '{pattern}'"
+                )
+        else:
+            domain = pattern[2:] if pattern.startswith("*.") else pattern
+        if not domain or "*" in domain or "" in domain.split("."):
+            raise ValueError(
+                f"line {line_number}: invalid domain pattern '{pattern}'"
+            )
+        rules.append((pattern, label_name))
+    return rules
+
+
+class RuleTable:
+    """Compiled rules resolving sender addresses to label names"""
+
+    def __init__(self, trie=None, addresses=None):
+        self.trie = trie or {}
+        self.addresses = addresses or {}
+
+    @classmethod
+    def compile(cls, rules):
+        table = cls()
+        for pattern, label_name in rules:
+            if "@" in pattern:
+                table.addresses[pattern] = label_name
+                continue
+            key = EXACT_KEY
+            if pattern.startswith("*."):
+                (pattern, key) = (pattern[2:], WILDCARD_KEY)
+            node = table.trie
+            for component in reversed(pattern.split(".")):
+                node = node.setdefault(component, {})
+            node[key] = label_name
+        return table
+
+    def match(self, sender_address, fq_domain):
+        """Returns the label name of the most specific rule or None"""
+        label_name = self.addresses.get(sender_address)
+        if label_name is not None:
+            return label_name
+        node = self.trie
+        for component in reversed(fq_domain.split(".")):
+            # Wildcards of a node only match its subdomains
+            label_name = node.get(WILDCARD_KEY, label_name)
+            node = node.get(component)
+            if node is None:
+                return label_name
+        return node.get(EXACT_KEY, label_name)
+
+    @property
+    def label_names(self):
+        names = set(self.addresses.values())
+        nodes = [self.trie]
+        while nodes:
+            node = nodes.pop()
+            for key, value in node.items():
+                if key in (EXACT_KEY, WILDCARD_KEY):
+                    names.add(value)
+                else:
+                    nodes.append(value)
+        return names
+
+    def to_dict(self):
+        return {"trie": self.trie, "addresses": self.addresses}
+
+
+def load_rules(rules_file, cache_dir):
+    """Returns the compiled rules of the rules file
+
+    The compiled rules are taken from the cache if the rules file has not
+    changed since, otherwise the cache is replaced.
+    """
+    try:
+        with open(rules_file, "rb") as rules_data:
+            data = rules_data.read()
+    except OSError as err:
+        print(f"Cannot read rules file [{rules_file}]: {err}")
+        return (None, True)
+    rules_hash = hashlib.sha256(data).hexdigest()
+
+    cache_path = os.path.join(cache_dir, CACHE_FILE)
+    try:
+        with open(cache_path, encoding="utf-8") as cache_file:
+            cache = json.load(cache_file)
+        if cache.get("hash") == rules_hash:
+            return (RuleTable(cache["trie"], cache["addresses"]), False)
+    except FileNotFoundError:
+        pass
+    except (OSError, JSONDecodeError, KeyError, AttributeError) as err:
+        print(f"Cannot load rules cache, ignore [{cache_path}]: {err}")
+
+    try:
+        rules = parse_rules(data.decode("utf-8"))
+    except (UnicodeDecodeError, ValueError) as err:
+        print(f"Invalid rules file [{rules_file}]: {err}")
+        return (None, True)
+    table = RuleTable.compile(rules)
+    print(f"Compiled {len(rules)} rules [{rules_file}]")
+    file_utils.write_json(cache_path, dict(table.to_dict(), hash=rules_hash))
+    return (table, False)
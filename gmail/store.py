@@ -0,0 +1,298 @@
+"""Storage backends for profile data (messages, labels, history id)"""
+import json
+import os
+import sqlite3
+import sys
+from abc import ABC, abstractmethod
+
+from .message import Message
+
+
+class Store(ABC):
+    """Interface of profile storage backends
+
+    Messages are 'Message' objects and labels are dicts as returned by
+    the Gmail API, both keyed by their ids.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    @abstractmethod
+    def history_id(self):
+        """History id the stored data is synchronized to"""
+
+    @abstractmethod
+    def get_messages(self, message_ids=None):
+        """Returns all messages or only those with the given ids"""
+
+    @abstractmethod
+    def get_label_message_ids(self):
+        """Returns the inverted index from label ids to message id sets"""
+
+    @abstractmethod
+    def get_domain_message_ids(self):
+        """Returns message id sets by domain and fully qualified domain
+
+        Messages without sender address are listed under empty domains.
+        """
+
+    @abstractmethod
+    def get_labels(self):
+        """Returns all labels"""
+
+    @abstractmethod
+    def update(self, messages, deleted_ids, history_id):
+        """Upserts and deletes messages and sets the history id at once"""
+
+    @abstractmethod
+    def set_labels(self, labels):
+        """Replaces all labels"""
+
+    @property
+    @abstractmethod
+    def download_history_id(self):
+        """History id captured at the start of an unfinished download"""
+
+    @abstractmethod
+    def start_download(self, history_id):
+        """Records the history id at the start of an initial download"""
+
+    @abstractmethod
+    def get_message_ids(self):
+        """Returns the set of all message ids"""
+
+    @abstractmethod
+    def add_messages(self, messages):
+        """Stores messages of the initial download (checkpoint)"""
+
+    @abstractmethod
+    def finish_download(self):
+        """Completes the initial download by setting its history id"""
+
+    def close(self):
+        pass
+
+
+class SqliteStore(Store):
+    # Maximum number of parameters of a single query
+    MAX_QUERY_PARAMS = 500
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        # Checkpoints are written from the download threads (serialized
+        # by the caller)
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.execute("PRAGMA journal_mode = WAL")
+        # Messages store the fields used for analysis, sender address and
+        # domains are extracted once and indexed by domain, message_labels
+        # is the inverted index from label ids to message ids
+        with self.__db:
+            self.__db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+                CREATE TABLE IF NOT EXISTS messages (
+                    id TEXT PRIMARY KEY,
+                    label_ids TEXT NOT NULL,
+                    sender TEXT NOT NULL,
+                    subject TEXT NOT NULL,
+                    snippet TEXT NOT NULL,
+                    sender_address TEXT NOT NULL,
+                    fq_domain TEXT NOT NULL,
+                    domain TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS messages_domain
+                    ON messages (domain, fq_domain, id);
+                CREATE TABLE IF NOT EXISTS labels (
+                    id TEXT PRIMARY KEY,
+                    data TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS message_labels (
+                    label_id TEXT NOT NULL,
+                    message_id TEXT NOT NULL,
+                    PRIMARY KEY (label_id, message_id)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS message_labels_message_id
+                    ON message_labels (message_id);
+                """
+            )
+
+    def __insert_messages(self, messages):
+        messages = list(messages)
+        self.__delete_message_labels(msg.id for msg in messages)
+        self.__db.executemany(
+            "INSERT INTO message_labels (label_id, message_id) VALUES (?, ?)",
+            (
+                (label_id, msg.id)
+                for msg in messages
+                for label_id in msg.label_ids
+            ),
+        )
+        self.__db.executemany(
+            (
+                "INSERT OR REPLACE INTO messages (id, label_ids, sender,"
+                " subject, snippet, sender_address, fq_domain, domain)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+            ),
+            (
+                (
+                    msg.id,
+                    " ".join(msg.label_ids),
+                    msg.raw_sender,
+                    msg.raw_subject,
+                    msg.raw_snippet,
+                    msg.sender_address,
+                    msg.fq_domain,
+                    msg.domain,
+                )
+                for msg in messages
+            ),
+        )
+
+    def __delete_message_labels(self, message_ids):
+        self.__db.executemany(
+            "DELETE FROM message_labels WHERE message_id = ?",
+            ((msg_id,) for msg_id in message_ids),
+        )
+
+    def __get_meta(self, key, default=None):
+        row = self.__db.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else default
+
+    def __set_meta(self, key, value):
+        self.__db.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            (key, value),
+        )
+
+    @property
+    def history_id(self):
+        return self.__get_meta("history_id", "0")
+
+    def get_messages(self, message_ids=None):
+        query = (
+            "SELECT id, label_ids, sender, subject, snippet, sender_address,"
+            " fq_domain, domain FROM messages"
+        )
+        if message_ids is None:
+            rows = self.__db.execute(query)
+        else:
+            # Query ids in chunks (limited number of query parameters)
+            message_ids = list(message_ids)
+            chunks = [
+                message_ids[i : i + self.MAX_QUERY_PARAMS]
+                for i in range(0, len(message_ids), self.MAX_QUERY_PARAMS)
+            ]
+            rows = (
+                row
+                for chunk in chunks
+                for row in self.__db.execute(
+                    f"{query} WHERE id IN ({', '.join('?' * len(chunk))})",
+                    chunk,
+                )
+            )
+        return {
+            row[0]: Message(
+                row[0],
+                row[1].split(),
+                *row[2:5],
+                sender_domains=(row[5], sys.intern(row[6]), sys.intern(row[7])),
+            )
+            for row in rows
+        }
+
+    def get_domain_message_ids(self):
+        domain_message_ids = {}
+        for domain, fq_domain, msg_id in self.__db.execute(
+            "SELECT domain, fq_domain, id FROM messages ORDER BY domain,"
+            " fq_domain"
+        ):
+            domain_message_ids.setdefault(domain, {}).setdefault(
+                fq_domain, set()
+            ).add(msg_id)
+        return domain_message_ids
+
+    def get_label_message_ids(self):
+        label_message_ids = {}
+        for label_id, msg_id in self.__db.execute(
+            "SELECT label_id, message_id FROM message_labels"
+        ):
+            label_message_ids.setdefault(label_id, set()).add(msg_id)
+        return label_message_ids
+
+    def get_labels(self):
+        return {
+            label_id: json.loads(data)
+            for (label_id, data) in self.__db.execute(
+                "SELECT id, data FROM labels"
+            )
+        }
+
+    def update(self, messages, deleted_ids, history_id):
+        # Single transaction, either all changes are applied or none
+        with self.__db:
+            self.__insert_messages(messages)
+            deleted_ids = list(deleted_ids)
+            self.__delete_message_labels(deleted_ids)
+            self.__db.executemany(
+                "DELETE FROM messages WHERE id = ?",
+                ((msg_id,) for msg_id in deleted_ids),
+            )
+            self.__set_meta("history_id", str(history_id))
+
+    def set_labels(self, labels):
+        with self.__db:
+            self.__db.execute("DELETE FROM labels")
+            self.__db.executemany(
+                "INSERT INTO labels (id, data) VALUES (?, ?)",
+                (
+                    (lbl["id"], json.dumps(lbl, ensure_ascii=False))
+                    for lbl in labels
+                ),
+            )
+
+    @property
+    def download_history_id(self):
+        return self.__get_meta("download_history_id")
+
+    def start_download(self, history_id):
+        with self.__db:
+            self.__set_meta("download_history_id", str(history_id))
+
+    def get_message_ids(self):
+        return {
+            msg_id for (msg_id,) in self.__db.execute("SELECT id FROM messages")
+        }
+
+    def add_messages(self, messages):
+        with self.__db:
+            self.__insert_messages(messages)
+
+    def finish_download(self):
+        with self.__db:
+            self.__set_meta("history_id", self.download_history_id)
+            self.__db.execute(
+                "DELETE FROM meta WHERE key = 'download_history_id'"
+            )
+
+    def close(self):
+        self.__db.close()
+
+
+# Available storage backends and their file names in the profile dir
+STORES = {"sqlite": (SqliteStore, "userdata.sqlite")}
+
+
+def open_store(profile_path, backend="sqlite"):
+    (store_class, file_name) = STORES[backend]
+    return store_class(os.path.join(profile_path, file_name))
@@ -0,0 +1,94 @@
+"""HTTP transport for Gmail API requests
+
+Each thread gets its own transport keeping its connections alive, so
+TLS handshakes are only needed once per thread and host instead of once
+per request. Access tokens are taken from the client, which refreshes
+the credentials in one place for all threads.
+"""
+from threading import Lock
+
+import httplib2
+
+# Timeout of a single request in seconds
+TIMEOUT = 60
+
+# Sent with every request, Google APIs only compress responses for user
+# agents containing "gzip"
+USER_AGENT = "gmailsort (gzip)"
+
+
+class ConnectionStats:
+    """Number of requests and newly opened connections of all threads"""
+
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self.__lock = Lock()
+
+    def add(self, new_connection):
+        with self.__lock:
+            self.requests += 1
+            if new_connection:
+                self.connections += 1
+
+    @property
+    def reused(self):
+        """Number of requests sent over an already open connection"""
+        return self.requests - self.connections
+
+    def to_dict(self):
+        return {
+            "requests": self.requests,
+            "connections": self.connections,
+            "reused": self.reused,
+        }
+
+
+class Transport(httplib2.Http):
+    """Keep-alive HTTP connections of a single thread
+
+    Requests are authorized with the access token of the client and sent
+    once more with a refreshed token if it was rejected (401).
+    """
+
+    def __init__(self, client, stats):
+        super().__init__(timeout=TIMEOUT)
+        self.client = client
+        self.stats = stats
+        # Bytes of all response bodies (after decoding) of this thread
+        self.bytes_received = 0
+
+    # pylint: disable=too-many-arguments
+    def request(
+        self,
+        uri,
+        method="GET",
+        body=None,
+        headers=None,
+        redirections=httplib2.DEFAULT_MAX_REDIRECTS,
+        connection_type=None,
+    ):
+        headers = dict(headers or {})
+        headers["accept-encoding"] = "gzip"
+        # The client library already adds "(gzip)" to its user agent
+        user_agent = headers.get("user-agent", "")
+        headers["user-agent"] = (
+            f"gmailsort {user_agent}" if "gzip" in user_agent else USER_AGENT
+        )
+        token = self.client.get_token()
+        for _ in range(2):
+            headers["authorization"] = f"Bearer {token}"
+            (response, content) = super().request(
+                uri, method, body, headers, redirections, connection_type
+            )
+            self.bytes_received += len(content)
+            if response.status != 401:
+                break
+            self.client.metrics.add_retry(401)
+            token = self.client.get_token(failed_token=token)
+        return (response, content)
+
+    def _conn_request(self, conn, request_uri, method, body, headers):
+        # Connections without socket are (re)connected by httplib2
+        self.stats.add(conn.sock is None)
+        return super()._conn_request(conn, request_uri, method, body, headers)
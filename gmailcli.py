@@ -49,7 +49,7 @@ def main() -> None:
     profile_name = args.profile
     credentials_file = args.credentials
 
-    (creds, err) = gmail.authenticate(profile_name, credentials_file)
+    (client, err) = gmail.authenticate(profile_name, credentials_file)
     if err:
         sys.exit(1)
     profile_dir = gmail.get_profile_dir(profile_name)
@@ -58,7 +58,7 @@ def main() -> None:
     while True:
         try:
             line = input(">>> ")
-            (response, err) = gmail.execute(creds, line)
+            (response, err) = gmail.execute(client, line)
             if not err:
                 print(
                     json.dumps(
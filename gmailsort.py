@@ -10,9 +10,10 @@ import argcomplete
 
 from gmail import gmail
 from gmail.argparse_utils import checked_file_path, wrap_long, wrap_short
+from gmail.metrics import Report
 
 
-def cmd_analyze_messages(args):
+def cmd_analyze_messages(args, report):
     profile_name = args.profile
     credentials_file = args.credentials
     src_label = args.src_label
@@ -20,15 +21,20 @@ def cmd_analyze_messages(args):
     include_domains = args.include
     exclude_domains = args.exclude
     verbosity = args.verbose
+    engine = args.engine
     create_labels = args.create_labels
 
     try:
-        (creds, err) = gmail.authenticate(profile_name, credentials_file)
+        report.start_phase("authentication")
+        (client, err) = gmail.authenticate(profile_name, credentials_file)
         if err:
             sys.exit(1)
-        (userdata, err) = gmail.synchronize(creds, profile_name)
+        report.client = client
+        report.start_phase("sync")
+        (userdata, err) = gmail.synchronize(client, profile_name, engine)
         if err:
             sys.exit(1)
+        report.start_phase("analysis")
         # Label existency check
         if src_label and not gmail.label_exists(userdata, src_label):
             print(f"Label '{src_label}' does not exist")
@@ -79,11 +85,11 @@ def cmd_analyze_messages(args):
 
                     for message in messages:
                         if verbosity == 3:
-                            print(f'        {message["snippet"]}')
+                            print(f"        {message.snippet}")
                         else:
                             print(
                                 json.dumps(
-                                    message,
+                                    message.to_dict(),
                                     indent=2,
                                     ensure_ascii=False,
                                     sort_keys=True,
@@ -92,15 +98,16 @@ def cmd_analyze_messages(args):
 
         # Create labels
         if create_labels:
+            report.start_phase("labels")
             print("Create labels")
             if dst_label and not gmail.create_labels(
-                creds, userdata, [dst_label]
+                client, userdata, [dst_label]
             ):
                 sys.exit(1)
             label_names = []
             for domain in sorted(domains.keys()):
                 label_names.append(get_domain_str(domain))
-            if not gmail.create_labels(creds, userdata, label_names):
+            if not gmail.create_labels(client, userdata, label_names):
                 sys.exit(1)
 
     except KeyboardInterrupt:
@@ -108,7 +115,7 @@ def cmd_analyze_messages(args):
         sys.exit(1)
 
 
-def cmd_find_labels(args):
+def cmd_find_labels(args, report):
     profile_name = args.profile
     credentials_file = args.credentials
     src_label = args.src_label
@@ -116,15 +123,22 @@ def cmd_find_labels(args):
     include_domains = args.include
     exclude_domains = args.exclude
     verbosity = args.verbose
+    engine = args.engine
     sort_messages = args.sort_messages
+    dry_run = args.dry_run
+    rules_file = args.rules
 
     try:
-        (creds, err) = gmail.authenticate(profile_name, credentials_file)
+        report.start_phase("authentication")
+        (client, err) = gmail.authenticate(profile_name, credentials_file)
         if err:
             sys.exit(1)
-        (userdata, err) = gmail.synchronize(creds, profile_name)
+        report.client = client
+        report.start_phase("sync")
+        (userdata, err) = gmail.synchronize(client, profile_name, engine)
         if err:
             sys.exit(1)
+        report.start_phase("analysis")
         # Label existency check
         for label in [src_label, dst_label]:
             if label and not gmail.label_exists(userdata, label):
@@ -160,9 +174,9 @@ def cmd_find_labels(args):
         print(f"Find labels for {len(domains)} domains {dst_label_str}")
 
         # Find matching labels for sender domains (only checks last
-        # label component)
+        # label component), inexact matches are only reported verbosely
         found_labels = gmail.find_labels_by_suffix(
-            userdata, domains.keys(), dst_label
+            userdata, domains.keys(), dst_label, verbosity > 0
         )
 
         # Print results
@@ -183,54 +197,89 @@ def cmd_find_labels(args):
                         print(get_domain_str(domain))
                         print("    no label found")
 
-        # Sort messages
-        if sort_messages:
-            print("Sort messages")
-            for domain, fq_domains in sorted(domains.items()):
-                print(f"{get_domain_str(domain)}: ", end="")
-                if len(found_labels[domain]) == 0:
-                    print("no label found, ignore")
-                    continue
+        # Sort messages: first plan all label operations, then apply
+        # them at once
+        if sort_messages or dry_run:
+            report.start_phase("sorting")
+            print("Plan sorting messages")
+            # Messages matching rules are sorted by the rules, only the
+            # others by the labels found for their domains
+            rule_table = None
+            if rules_file:
+                (rule_table, err) = gmail.load_rules(profile_name, rules_file)
+                if err:
+                    sys.exit(1)
+            sorts = gmail.get_sorts(
+                userdata, domains, found_labels, rule_table, src_label
+            )
+            plan = gmail.plan_sort(userdata, sorts, src_label)
+            gmail.print_sort_plan(userdata, plan)
+            if not dry_run and not gmail.execute_sort_plan(client, plan):
+                sys.exit(1)
 
-                if len(found_labels[domain]) > 1:
-                    labels = list(
-                        map(lambda lbl: lbl["name"], found_labels[domain])
-                    )
-                    print(f"multiple labels found, ignore: {sorted(labels)}")
-                    continue
+    except KeyboardInterrupt:
+        print()
+        sys.exit(1)
 
-                # Merge messages from domain into single list
-                messages = []
-                list(map(messages.extend, fq_domains.values()))
-
-                # Partition messages by labels being sublabel of the
-                # source label
-                label_ids = gmail.partition_messages_by_prefix(
-                    userdata, messages, src_label
-                )
-
-                # Add and remove message labels
-                add_label_id = found_labels[domain][0]["id"]
-                add_label_name = userdata.labels[add_label_id]["name"]
-                for rm_label_id, messages in label_ids.items():
-                    # Ignore removing and adding the same label
-                    if rm_label_id == add_label_id:
-                        print(
-                            "removing and adding the same label, ignore:"
-                            f" '{add_label_name}'"
-                        )
-                        continue
-                    rm_label_ids = []
-                    label_str = f"add label '{add_label_name}'"
-                    if rm_label_id:
-                        rm_label_ids.append(rm_label_id)
-                        rm_label_name = userdata.labels[rm_label_id]["name"]
-                        label_str += f", remove label '{rm_label_name}'"
-                    print(label_str)
-                    if not gmail.modify_message_labels(
-                        creds, messages, [add_label_id], rm_label_ids
-                    ):
-                        sys.exit(1)
+
+def cmd_watch(args, report):
+    profile_name = args.profile
+    credentials_file = args.credentials
+    src_label = args.src_label
+    dst_label = args.dst_label
+    engine = args.engine
+    interval = args.interval
+    push_port = args.push_port
+    sort_messages = args.sort_messages
+    rules_file = args.rules
+
+    try:
+        report.start_phase("authentication")
+        (client, err) = gmail.authenticate(profile_name, credentials_file)
+        if err:
+            sys.exit(1)
+        report.client = client
+        rule_table = None
+        if rules_file:
+            (rule_table, err) = gmail.load_rules(profile_name, rules_file)
+            if err:
+                sys.exit(1)
+        report.start_phase("watch")
+        if not gmail.watch(
+            client,
+            profile_name,
+            engine,
+            src_label,
+            dst_label,
+            interval,
+            sort_messages,
+            push_port,
+            rule_table,
+        ):
+            sys.exit(1)
+
+    except KeyboardInterrupt:
+        # Regular way to stop watching
+        print()
+        print("Stop watching")
+
+
+def cmd_sync_all(args, report):
+    credentials_file = args.credentials
+    engine = args.engine
+    jobs = args.jobs
+
+    try:
+        profile_names = gmail.get_profile_names()
+        if not profile_names:
+            print(f"No profiles found under '{gmail.get_profile_dir()}'")
+            sys.exit(1)
+        report.start_phase("sync")
+        report.profiles = gmail.sync_profiles(
+            profile_names, credentials_file, engine, jobs
+        )
+        if not all(profile["success"] for profile in report.profiles):
+            sys.exit(1)
 
     except KeyboardInterrupt:
         print()
@@ -256,9 +305,8 @@ def main() -> None:
         metavar="NAME",
         help=wrap_short(
             "profile name to store Gmail access token and message data under"
-            f" '{gmail.get_profile_dir()}'"
+            f" '{gmail.get_profile_dir()}' (required except for sync-all)"
         ),
-        required=True,
     )
     parser.add_argument(
         "-c",
@@ -271,6 +319,23 @@ def main() -> None:
         default="credentials.json",
         type=checked_file_path,
     )
+    parser.add_argument(
+        "--engine",
+        help=wrap_short(
+            "engine used to download message data, either a thread pool or"
+            " asyncio (default: thread)"
+        ),
+        choices=sorted(gmail.ENGINES.keys()),
+        default="thread",
+    )
+    parser.add_argument(
+        "--stats",
+        metavar="FILE",
+        help=wrap_short(
+            "write a json report with phase timings and API call metrics"
+            " (calls, latencies, retries, quota units, bytes) to this file"
+        ),
+    )
 
     # analyze-command arguments
     analyze_parser = cmd_parser.add_parser(
@@ -402,8 +467,9 @@ def main() -> None:
         "-v",
         "--verbose",
         help=wrap_short(
-            "print details about search result (v: only domains with found"
-            " labels, vv: only domains with no labels found, vvv: both)"
+            "print details about search result including inexact label"
+            " matches (v: only domains with found labels, vv: only domains"
+            " with no labels found, vvv: both)"
         ),
         action="count",
         default=0,
@@ -413,14 +479,137 @@ def main() -> None:
         help=wrap_short("messages are actually sorted (modifies Gmail data)"),
         action="store_true",
     )
+    find_parser.add_argument(
+        "--dry-run",
+        help=wrap_short(
+            "only print the label operations for sorting messages (does not"
+            " modify Gmail data)"
+        ),
+        action="store_true",
+    )
+    find_parser.add_argument(
+        "--rules",
+        metavar="FILE",
+        help=wrap_short(
+            "sort messages by the rules of this file first, each line maps"
+            " a sender domain (example.com), its subdomains (*.example.com) or"
+            " a sender address (name@example.com) to a label name"
+        ),
+        type=checked_file_path,
+    )
     find_parser.set_defaults(func=cmd_find_labels)
 
+    # watch-command arguments
+    watch_parser = cmd_parser.add_parser(
+        "watch",
+        help=wrap_short("watch for new messages (and sort them on demand)"),
+        description=wrap_long(
+            "Keeps the local message data synchronized with Gmail by polling"
+            " for changes until interrupted. Newly arrived messages are sorted"
+            " like with the find command, i.e., into the single label matching"
+            " their sender domain. Optionally, Gmail push notifications"
+            " (delivered by a Cloud Pub/Sub push subscription to a local port)"
+            " trigger synchronization immediately."
+        ),
+        formatter_class=RawTextHelpFormatter,
+    )
+    watch_parser.add_argument(
+        "-s",
+        "--src-label",
+        metavar="LABEL",
+        help=wrap_short(
+            "only sort new messages from this label excluding SPAM, SENT, and"
+            " DRAFT (if not specified, all new messages are sorted excluding"
+            " SPAM, SENT, and DRAFT)"
+        ),
+    )
+    watch_parser.add_argument(
+        "-d",
+        "--dst-label",
+        metavar="LABEL",
+        help=wrap_short(
+            "look for labels from this label (if not specified, labels are"
+            " looked up top level)"
+        ),
+    )
+    watch_parser.add_argument(
+        "--interval",
+        metavar="SECONDS",
+        help=wrap_short(
+            "time between two polls for changes (default:"
+            f" {gmail.WATCH_INTERVAL})"
+        ),
+        type=float,
+        default=gmail.WATCH_INTERVAL,
+    )
+    watch_parser.add_argument(
+        "--push-port",
+        metavar="PORT",
+        help=wrap_short(
+            "listen for push notifications on this local port (0: any free"
+            " port)"
+        ),
+        type=int,
+    )
+    watch_parser.add_argument(
+        "--sort-messages",
+        help=wrap_short(
+            "new messages are actually sorted (modifies Gmail data), otherwise"
+            " only the label operations are printed"
+        ),
+        action="store_true",
+    )
+    watch_parser.add_argument(
+        "--rules",
+        metavar="FILE",
+        help=wrap_short(
+            "sort new messages by the rules of this file first, each line maps"
+            " a sender domain (example.com), its subdomains (*.example.com) or"
+            " a sender address (name@example.com) to a label name"
+        ),
+        type=checked_file_path,
+    )
+    watch_parser.set_defaults(func=cmd_watch)
+
+    # sync-all-command arguments
+    sync_all_parser = cmd_parser.add_parser(
+        "sync-all",
+        help=wrap_short("synchronize all profiles concurrently"),
+        description=wrap_long(
+            "Synchronizes the local message data of all profiles found under"
+            f" '{gmail.get_profile_dir()}' with Gmail, each profile in its own"
+            " process with its own quota budget. Profiles requiring a login at"
+            " Gmail or failing otherwise are skipped, their output is written"
+            f" to '{gmail.SYNC_LOG_FILE}' in the profile directory."
+        ),
+        formatter_class=RawTextHelpFormatter,
+    )
+    sync_all_parser.add_argument(
+        "-j",
+        "--jobs",
+        metavar="N",
+        help=wrap_short(
+            "number of profiles synchronized at the same time (default: number"
+            " of CPUs)"
+        ),
+        type=int,
+    )
+    sync_all_parser.set_defaults(func=cmd_sync_all)
+
     # Enable autocompletion
     argcomplete.autocomplete(parser)
 
     # Parse arguments and dispatch command
     args = parser.parse_args()
-    args.func(args)
+    if not args.profile and args.command != "sync-all":
+        parser.error("the following arguments are required: -p/--profile")
+    with Report(args.stats, args.command, args.profile) as report:
+        try:
+            args.func(args, report)
+        finally:
+            # Thread pools of the client are not stopped at exit otherwise
+            if report.client:
+                report.client.close()
 
 
 if __name__ == "__main__":